@@ -3,7 +3,20 @@ from flask_login import LoginManager, logout_user, login_required
 import config
 from model import *  
 from routes import *  
+from utils import upgrade_schema, recount_lot_counters, sync_user_flags
+from rollups import backfill_rollups, refresh_rollups
+import search_index
+from sweeper import sweep, scheduler
+from query_plans import check_query_plans
+from exports import FORMATS, reservation_filters, export_reservations
+from user_cache import load_user
+import images
+import assets
+import sql_profiler
+import metrics
 import os
+from datetime import datetime, timedelta
+import click
 
 
 app = Flask(__name__, static_folder='static', static_url_path='/static')
@@ -18,13 +31,26 @@ except Exception as e:
     
     
 db.init_app(app)
+sql_profiler.init_app(app)
+metrics.init_app(app)
 
 app.register_blueprint(admin_bp, url_prefix='/admin')
 app.register_blueprint(user_bp, url_prefix='/user')
+app.register_blueprint(api_bp, url_prefix='/api')
+
+scheduler.init_app(app)
+images.init_app(app)
+assets.init_app(app)
 
 with app.app_context():
     # db.drop_all()
     db.create_all()
+    added_columns = upgrade_schema()
+    if any(col.startswith('parking_lot.') and col.endswith('_count') for col in added_columns):
+        recount_lot_counters()
+    if 'user.flagged' in added_columns:
+        sync_user_flags()
+    search_index.ensure_search_index()
     
     
 
@@ -35,15 +61,108 @@ def index():
 ########################################################################################
 
 
+@app.cli.command('repair-counters')
+def repair_counters():
+    """Recompute lot occupied/booked/free counters and user flag columns."""
+    repaired = recount_lot_counters()
+    print(f"Repaired counters on {repaired} parking lot(s).")
+    repaired = sync_user_flags()
+    print(f"Repaired flag state of {repaired} user(s).")
+
+
+@app.cli.command('reindex-search')
+def reindex_search():
+    """Rebuild the admin full-text search index."""
+    if not search_index.is_enabled():
+        print("Full-text search needs SQLite with FTS5; admin search uses LIKE instead.")
+        return
+    search_index.reindex()
+    print("Search index rebuilt.")
+
+
+@app.cli.command('backfill-rollups')
+def backfill_rollups_command():
+    """Rebuild the reservation rollup tables from the full history."""
+    backfill_rollups()
+    print("Reservation rollups rebuilt.")
+
+
+@app.cli.command('refresh-rollups')
+def refresh_rollups_command():
+    """Fold reservations changed since the last run into the rollups (cron friendly)."""
+    rebuilt = refresh_rollups()
+    print("No watermark yet, ran a full backfill." if rebuilt is None else f"Rebuilt {rebuilt} rollup bucket(s).")
+
+
+@app.cli.command('sweep')
+def sweep_command():
+    """Reject no-shows and expired requests once, releasing their spots."""
+    result = sweep(batch_size=app.config['SWEEPER_BATCH_SIZE'])
+    print(f"Rejected {result['no_shows_rejected']} no-show(s) and {result['pending_expired']} expired request(s); "
+          f"released {result['spots_released']} spot(s), promoted {result['promoted']} waiting request(s).")
+
+
+@app.cli.command('process-images')
+def process_images_command():
+    """Make thumbnails and WebP copies of uploads that don't have them yet."""
+    if images.Image is None:
+        print("Pillow is not installed; uploads are served as they were sent.")
+        return
+    queued = images.process_existing(app.config['UPLOAD_FOLDER'])
+    images.wait()
+    print(f"Processed {queued} image(s).")
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Write fingerprinted, precompressed copies of the static assets to static/dist."""
+    built = assets.build_assets(app.static_folder)
+    print(f"Built {len(built)} asset(s){'' if assets.brotli else ' (install brotli for .br copies)'}.")
+
+
+@app.cli.command('export-reservations')
+@click.option('--format', 'fmt', type=click.Choice(list(FORMATS)), default='csv', show_default=True)
+@click.option('--month', help='YYYY-MM; shorthand for --from/--to covering that month.')
+@click.option('--from', 'date_from', type=click.DateTime(['%Y-%m-%d']), help='First booking date (inclusive).')
+@click.option('--to', 'date_to', type=click.DateTime(['%Y-%m-%d']), help='Last booking date (inclusive).')
+@click.option('--lot', 'lot_id', type=int, help='Only this parking lot.')
+@click.option('--status', help='Only reservations in this status.')
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-', help='File to write (default stdout).')
+def export_reservations_command(fmt, month, date_from, date_to, lot_id, status, output):
+    """Stream reservations with their user, vehicle, lot and spot as CSV or NDJSON."""
+    date_from, date_to = date_from and date_from.date(), date_to and date_to.date()
+    if month:
+        try:
+            date_from = datetime.strptime(month, '%Y-%m').date()
+        except ValueError:
+            raise click.BadParameter('expected YYYY-MM', param_hint='--month')
+        date_to = (date_from + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    filters = reservation_filters(lot_id=lot_id, status=status, date_from=date_from, date_to=date_to)
+    for chunk in export_reservations(fmt, filters):
+        output.write(chunk)
+
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if any hot query does a full table scan on a seeded database."""
+    failures = 0
+    for name, plan, scans in check_query_plans():
+        print(f"{'FAIL' if scans else 'ok  '} {name}")
+        for detail in plan:
+            print(f"       {detail}")
+        failures += bool(scans)
+    if failures:
+        print(f"{failures} query plan(s) fell back to a full table scan.")
+        raise SystemExit(1)
+    print("All hot queries use an index.")
+
+
 
 
 login_manager = LoginManager(app)
 login_manager.login_view = 'user.user_login'
 
-@login_manager.user_loader
-def load_user(user_id):
-    user = User.query.get(user_id)
-    return user
+login_manager.user_loader(load_user)
 
 @app.route('/logout')
 @login_required  
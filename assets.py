@@ -0,0 +1,122 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+
+from flask import request, send_from_directory, current_app
+
+try:
+    import brotli
+except ImportError:  # optional; without it only gzip copies are written
+    brotli = None
+
+# Folders under static/ that are fingerprinted (uploads change at runtime, so never)
+ASSET_DIRS = ('style', 'scripts', 'image', 'icon')
+DIST_DIR = 'dist'
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# logical path (e.g. 'style/index.css') -> fingerprinted path under static/
+manifest = {}
+
+
+def _fingerprinted(path, digest):
+    stem, extension = os.path.splitext(path)
+    return f'{DIST_DIR}/{stem}.{digest}{extension}'
+
+
+def _write_once(path, data):
+    if os.path.exists(path):
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.part'
+    with open(temp_path, 'wb') as out:
+        out.write(data)
+    os.replace(temp_path, path)
+    return True
+
+
+def build_assets(static_folder):
+    """Copy every asset to static/dist under a content-hashed name.
+
+    Text assets also get .gz (and, with the brotli package, .br) siblings.
+    Files already built are left alone, so rebuilding is cheap. Writes and
+    returns the manifest.
+    """
+    built = {}
+    for folder in ASSET_DIRS:
+        for root, _, files in os.walk(os.path.join(static_folder, folder)):
+            for name in sorted(files):
+                source = os.path.join(root, name)
+                logical = os.path.relpath(source, static_folder).replace(os.sep, '/')
+                with open(source, 'rb') as f:
+                    data = f.read()
+                target = _fingerprinted(logical, hashlib.sha256(data).hexdigest()[:12])
+                target_path = os.path.join(static_folder, target)
+                _write_once(target_path, data)
+                if name.lower().endswith(COMPRESSIBLE):
+                    _write_once(target_path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+                    if brotli is not None:
+                        _write_once(target_path + '.br', brotli.compress(data))
+                built[logical] = target
+
+    os.makedirs(os.path.join(static_folder, DIST_DIR), exist_ok=True)
+    with open(os.path.join(static_folder, DIST_DIR, 'manifest.json'), 'w') as f:
+        json.dump(built, f, indent=2, sort_keys=True)
+    manifest.clear()
+    manifest.update(built)
+    return built
+
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, 'manifest.json')) as f:
+            manifest.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    return manifest
+
+
+def _rewrite_static_urls(endpoint, values):
+    # In debug mode edited stylesheets must show up on reload, so link the originals
+    if endpoint == 'static' and 'filename' in values and not current_app.debug:
+        fingerprinted = manifest.get(values['filename'].lstrip('/'))
+        if fingerprinted:
+            values['filename'] = fingerprinted
+
+
+def serve_static(filename):
+    """The static view, serving fingerprinted files precompressed and immutable."""
+    if not filename.startswith(DIST_DIR + '/'):
+        return current_app.send_static_file(filename)
+
+    accepted = request.accept_encodings
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if accepted[encoding] and os.path.isfile(os.path.join(current_app.static_folder, filename + suffix)):
+            response = send_from_directory(
+                current_app.static_folder, filename + suffix,
+                mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            )
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = current_app.send_static_file(filename)
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def init_app(app):
+    """Link and serve static files through the manifest.
+
+    With ASSETS_BUILD_ON_START the assets are (re)built at startup, which
+    only writes files whose content changed; otherwise the manifest from
+    the last ``flask build-assets`` is used.
+    """
+    app.view_functions['static'] = serve_static
+    if app.config['ASSETS_BUILD_ON_START']:
+        build_assets(app.static_folder)
+    else:
+        load_manifest(app.static_folder)
+    app.url_defaults(_rewrite_static_urls)
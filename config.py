@@ -10,5 +10,19 @@ def configure_app(app):
     app.config['UPLOAD_FOLDER'] = 'static/uploads'
     app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg'}
     app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max-limit
+    app.config['ASSETS_BUILD_ON_START'] = os.getenv('ASSETS_BUILD_ON_START', 'true').lower() == 'true'  # fingerprint static files at startup
+    app.config['SQL_PROFILER'] = os.getenv('SQL_PROFILER', 'false').lower() == 'true'  # per-request query counts and N+1 detection
+    app.config['SQL_PROFILER_N_PLUS_ONE'] = int(os.getenv('SQL_PROFILER_N_PLUS_ONE', 5))  # repeats of one statement that flag an N+1
+    app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN', '')  # bearer token required to scrape /metrics; empty lets anyone read it
+    app.config['METRICS_DIR'] = os.getenv('METRICS_DIR', '')  # directory the workers of one host share so /metrics reports them all
+    app.config['IMAGE_WORKERS'] = int(os.getenv('IMAGE_WORKERS', 2))  # threads making thumbnails of uploads
+    app.config['ADMIN_KPI_TTL'] = float(os.getenv('ADMIN_KPI_TTL', 5))  # seconds
+    app.config['USER_CACHE_TTL'] = float(os.getenv('USER_CACHE_TTL', 60))  # seconds a logged-in user is served without a query; other workers' GET pages may see a flag that late
+    app.config['ROLLUP_MAX_AGE'] = float(os.getenv('ROLLUP_MAX_AGE', 300))  # seconds before analytics fall back to live queries
+    app.config['SWEEPER_INTERVAL'] = float(os.getenv('SWEEPER_INTERVAL', 60))  # seconds, 0 disables the background sweeper
+    app.config['SWEEPER_BATCH_SIZE'] = int(os.getenv('SWEEPER_BATCH_SIZE', 500))
+    app.config['API_VERSION_TTL'] = float(os.getenv('API_VERSION_TTL', 1))  # seconds a worker trusts its lot versions for 304s
+    app.config['LIVE_POLL_INTERVAL'] = float(os.getenv('LIVE_POLL_INTERVAL', 5))  # seconds between checks for changes made by other workers
+    app.config['ROLLUP_REFRESH_INTERVAL'] = float(os.getenv('ROLLUP_REFRESH_INTERVAL', 120))  # seconds, 0 leaves it to cron
     
 
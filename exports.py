@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta
+import csv
+import io
+import json
+
+from sqlalchemy import select
+
+from model import *
+
+# (column name, SQL expression) of every exported reservation row
+EXPORT_COLUMNS = [
+    ('reservation_id', Reservation.id),
+    ('booking_id', Reservation.booking_id),
+    ('status', Reservation.status),
+    ('booked_at', Reservation.booking_timestamp),
+    ('expected_arrival', Reservation.expected_arrival),
+    ('expected_departure', Reservation.expected_departure),
+    ('parked_at', Reservation.parking_timestamp),
+    ('left_at', Reservation.leaving_timestamp),
+    ('parking_cost', Reservation.parking_cost),
+    ('cancellation_reason', Reservation.cancellation_reason),
+    ('lot_id', ParkingLot.id),
+    ('lot_name', ParkingLot.prime_location_name),
+    ('price_per_hour', ParkingLot.price_per_hour),
+    ('spot_number', ParkingSpot.spot_number),
+    ('user_id', User.id),
+    ('user_email', User.email),
+    ('user_name', (func.coalesce(User.firstname, '') + ' ' + func.coalesce(User.lastname, ''))),
+    ('license_plate', Vehicle.license_plate),
+    ('vehicle_name', Vehicle.vehicle_name),
+]
+FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+
+def reservation_filters(lot_id=None, date_from=None, date_to=None, status=None):
+    """Filters on the reservation's lot, status and booking date (both dates inclusive)."""
+    filters = []
+    if lot_id:
+        filters.append(Reservation.lot_id == lot_id)
+    if status:
+        filters.append(Reservation.status == status)
+    if date_from:
+        filters.append(Reservation.booking_timestamp >= datetime.combine(date_from, datetime.min.time()))
+    if date_to:
+        filters.append(Reservation.booking_timestamp < datetime.combine(date_to + timedelta(days=1), datetime.min.time()))
+    return filters
+
+
+def export_rows(filters, batch_size=1000):
+    """Reservations joined with their lot, spot, user and vehicle, as tuples in
+    EXPORT_COLUMNS order. Rows are fetched ``batch_size`` at a time, so memory
+    stays flat however many match."""
+    statement = select(*[column.label(name) for name, column in EXPORT_COLUMNS]).select_from(Reservation).outerjoin(
+        ParkingLot, ParkingLot.id == Reservation.lot_id
+    ).outerjoin(
+        ParkingSpot, ParkingSpot.id == Reservation.spot_id
+    ).outerjoin(
+        User, User.id == Reservation.user_id
+    ).outerjoin(
+        Vehicle, Vehicle.id == Reservation.vehicle_id
+    ).where(*filters).order_by(Reservation.booking_timestamp, Reservation.id)
+
+    result = db.session.execute(statement, execution_options={'yield_per': batch_size, 'stream_results': True})
+    for partition in result.partitions():
+        yield from partition
+
+
+def write_csv(rows, batch_size=1000):
+    """CSV text in chunks of about ``batch_size`` rows, header first.
+    Timestamps come out as 'YYYY-MM-DD HH:MM:SS[.ffffff]'."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, _ in EXPORT_COLUMNS])
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def write_ndjson(rows, batch_size=1000):
+    """One JSON object per line, in chunks of about ``batch_size`` rows."""
+    names = [name for name, _ in EXPORT_COLUMNS]
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps(dict(zip(names, row)), default=str) + '\n')
+        if len(chunk) >= batch_size:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+WRITERS = {'csv': write_csv, 'ndjson': write_ndjson}
+
+
+def export_reservations(fmt, filters, batch_size=1000):
+    """Chunks of the export in ``fmt`` ('csv' or 'ndjson')."""
+    return WRITERS[fmt](export_rows(filters, batch_size), batch_size)
@@ -0,0 +1,121 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+import os
+
+from flask import current_app
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; uploads are then kept as sent
+    Image = None
+
+log = logging.getLogger(__name__)
+
+# Variant name -> bounding box; each is written next to the original as <stem>.<name>.webp
+VARIANTS = {
+    'thumb': (320, 320),
+    'display': (1280, 1280),
+}
+
+_executor = None
+
+
+def init_app(app):
+    global _executor
+    _executor = ThreadPoolExecutor(max_workers=app.config['IMAGE_WORKERS'], thread_name_prefix='images')
+    app.jinja_env.filters['thumb'] = variant_url
+
+
+def variant_path(path, variant):
+    return f'{os.path.splitext(path)[0]}.{variant}.webp'
+
+
+def variant_url(path, variant='thumb'):
+    """Static path of a processed variant of an upload, or the upload itself
+    until the variant exists (or when Pillow isn't installed)."""
+    if not path:
+        return path
+    candidate = variant_path(path, variant)
+    if os.path.isfile(os.path.join(current_app.static_folder, candidate)):
+        return candidate
+    return path
+
+
+def save_upload(file, folder):
+    """Store an uploaded image under UPLOAD_FOLDER/<folder>, named by its content.
+
+    Identical uploads share one file (and one set of variants). Thumbnails,
+    WebP copies and metadata stripping happen on the worker pool; the
+    request only hashes and writes the bytes. Returns the path relative to
+    UPLOAD_FOLDER.
+    """
+    data = file.read()
+    extension = os.path.splitext(file.filename)[1].lower()
+    name = hashlib.sha256(data).hexdigest()[:32] + extension
+    upload_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], folder)
+    os.makedirs(upload_dir, exist_ok=True)
+    full_path = os.path.abspath(os.path.join(upload_dir, name))
+
+    if not os.path.exists(full_path):
+        temp_path = f'{full_path}.{os.getpid()}.part'
+        with open(temp_path, 'wb') as out:
+            out.write(data)
+        os.replace(temp_path, full_path)
+        process_later(full_path)
+    return f'{folder}/{name}'
+
+
+def process_later(full_path):
+    if Image is not None and _executor is not None:
+        _executor.submit(_process, full_path)
+
+
+def _process(full_path):
+    try:
+        with Image.open(full_path) as original:
+            image_format = original.format
+            image = ImageOps.exif_transpose(original)
+            image.load()
+
+        # Rewriting the pixels alone drops EXIF (GPS, camera serials) and other metadata
+        temp_path = f'{full_path}.{os.getpid()}.part'
+        image.save(temp_path, format=image_format)
+        os.replace(temp_path, full_path)
+
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+        for variant, size in VARIANTS.items():
+            resized = image.copy()
+            resized.thumbnail(size)
+            resized.save(variant_path(full_path, variant), format='WEBP', quality=80, method=4)
+    except Exception:
+        log.exception("Could not process uploaded image %s", full_path)
+
+
+def remove_upload(full_path):
+    """Delete an upload and its variants."""
+    for path in [full_path] + [variant_path(full_path, variant) for variant in VARIANTS]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def process_existing(upload_folder):
+    """Queue every upload that has no variants yet. Returns how many were queued."""
+    queued = 0
+    for root, _, files in os.walk(upload_folder):
+        for name in files:
+            stem, extension = os.path.splitext(name)
+            if extension == '.webp' or extension == '.part':
+                continue
+            full_path = os.path.abspath(os.path.join(root, name))
+            if not all(os.path.exists(variant_path(full_path, variant)) for variant in VARIANTS):
+                process_later(full_path)
+                queued += 1
+    return queued
+
+
+def wait():
+    """Block until queued images are processed (used by the CLI)."""
+    if _executor is not None:
+        _executor.shutdown(wait=True)
@@ -0,0 +1,223 @@
+from collections import deque
+from threading import Thread, Event, Lock
+import json
+import queue
+
+from flask import Response, current_app
+from sqlalchemy import select
+
+from model import *
+
+KEEPALIVE = 15  # seconds between SSE comments that keep proxies from closing the stream
+
+# Streams subscribe to one channel: 'spots' events carry the counters and the
+# spots whose status changed (admin dashboard grid), 'counts' events only the
+# counters (user locations page)
+CHANNELS = ('spots', 'counts')
+COUNT_KEYS = ('lot_id', 'location_id', 'is_active', 'free', 'booked', 'occupied', 'available')
+
+
+def _lot_snapshots(conn, lot_ids=None, with_spots=True):
+    """Occupancy of the given lots (all lots when None), keyed by lot id.
+
+    Without ``with_spots`` the per-spot statuses are skipped and
+    ``spots`` is None.
+    """
+    lots = select(
+        ParkingLot.id, ParkingLot.location_id, ParkingLot.is_active, ParkingLot.occupancy_version,
+        ParkingLot.free_count, ParkingLot.booked_count, ParkingLot.occupied_count
+    )
+    spots = select(ParkingSpot.lot_id, ParkingSpot.id, ParkingSpot.status)
+    if lot_ids is not None:
+        lots = lots.where(ParkingLot.id.in_(lot_ids))
+        spots = spots.where(ParkingSpot.lot_id.in_(lot_ids))
+
+    snapshots = {}
+    for lot in conn.execute(lots):
+        snapshots[lot.id] = {
+            'lot_id': lot.id,
+            'location_id': lot.location_id,
+            'is_active': bool(lot.is_active),
+            'version': lot.occupancy_version,
+            'free': lot.free_count,
+            'booked': lot.booked_count,
+            'occupied': lot.occupied_count,
+            'available': lot.free_count + lot.booked_count,  # not occupied right now
+            'spots': {} if with_spots else None,
+        }
+    if not with_spots:
+        return snapshots
+    for lot_id, spot_id, status in conn.execute(spots):
+        if lot_id in snapshots:
+            snapshots[lot_id]['spots'][spot_id] = status
+    return snapshots
+
+
+def _counts(snapshot):
+    return {key: snapshot[key] for key in COUNT_KEYS}
+
+
+def _spot_changes(previous, snapshot):
+    """Spots whose status differs from the previous snapshot; removed spots map to None."""
+    if snapshot['spots'] is None:
+        return {}
+    old = previous['spots'] if previous and previous['spots'] is not None else {}
+    changes = {spot_id: status for spot_id, status in snapshot['spots'].items() if old.get(spot_id) != status}
+    changes.update({spot_id: None for spot_id in old if spot_id not in snapshot['spots']})
+    return changes
+
+
+class AvailabilityBroker:
+    """Pushes per-lot occupancy deltas to Server-Sent Event subscribers.
+
+    Commits that change a lot only mark it dirty; one background thread
+    reads the dirty lots once and fans the result out to every open
+    stream, so the work is per change rather than per viewer. Events only
+    carry what moved since the last one: the lot counters, plus the changed
+    spots for 'spots' subscribers. Spot statuses are not even read while
+    nobody subscribes to them. Between
+    changes the thread polls the lot versions every ``poll_interval``
+    seconds to pick up commits made by other worker processes.
+    """
+
+    def __init__(self, history=256, queue_size=64):
+        self.poll_interval = 5
+        self.queue_size = queue_size
+        self._history = deque(maxlen=history)  # (event id, {channel: payload}) for Last-Event-ID replays
+        self._subscribers = {}  # queue -> channel
+        self._published = {}  # lot id -> last snapshot sent
+        self._dirty = set()
+        self._wake = Event()
+        self._lock = Lock()
+        self._last_id = 0
+        self._thread = None
+
+    def mark_dirty(self, lot_ids):
+        if not self._subscribers:
+            return
+        with self._lock:
+            self._dirty.update(lot_ids)
+        self._wake.set()
+
+    def subscribe(self, app, channel='spots'):
+        subscriber = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._subscribers[subscriber] = channel
+            if self._thread is None:
+                self.poll_interval = app.config['LIVE_POLL_INTERVAL']
+                self._thread = Thread(target=self._run, args=(app,), daemon=True)
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.pop(subscriber, None)
+
+    def _wants_spots(self):
+        with self._lock:
+            return 'spots' in self._subscribers.values()
+
+    def _run(self, app):
+        with app.app_context():
+            with db.engine.connect() as conn:
+                self._published = _lot_snapshots(conn, with_spots=self._wants_spots())
+            while True:
+                woken = self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                with self._lock:
+                    if not self._subscribers:
+                        self._thread = None
+                        return
+                    dirty, self._dirty = self._dirty, set()
+                try:
+                    with db.engine.connect() as conn:
+                        if not woken:
+                            dirty = self._versions_moved(conn)
+                        if dirty:
+                            self._publish(_lot_snapshots(conn, dirty, with_spots=self._wants_spots()))
+                except Exception:
+                    app.logger.exception("Availability broker failed to read lot occupancy")
+
+    def _versions_moved(self, conn):
+        # Cheap check for commits made by other processes
+        return {
+            lot_id for lot_id, version in conn.execute(select(ParkingLot.id, ParkingLot.occupancy_version))
+            if lot_id not in self._published or self._published[lot_id]['version'] != version
+        }
+
+    def _publish(self, snapshots):
+        spot_events, count_events = [], []
+        for lot_id, snapshot in snapshots.items():
+            previous = self._published.get(lot_id)
+            if previous == snapshot:
+                continue
+            self._published[lot_id] = snapshot
+            counts = _counts(snapshot)
+            counts_moved = previous is None or counts != _counts(previous)
+            spots = _spot_changes(previous, snapshot)
+            if spots or counts_moved:
+                spot_events.append(dict(counts, spots=spots))
+            if counts_moved:
+                count_events.append(counts)
+        if not spot_events:
+            return
+
+        payloads = {'spots': json.dumps(spot_events), 'counts': json.dumps(count_events) if count_events else None}
+        with self._lock:
+            self._last_id += 1
+            self._history.append((self._last_id, payloads))
+            subscribers = list(self._subscribers.items())
+        for subscriber, channel in subscribers:
+            if payloads[channel] is None:
+                continue
+            try:
+                subscriber.put_nowait((self._last_id, payloads[channel]))
+            except queue.Full:
+                # Too slow to keep up; the browser reconnects and replays
+                self.unsubscribe(subscriber)
+
+    def _replay(self, last_event_id, channel):
+        with self._lock:
+            history = list(self._history)
+        if not history or not history[0][0] - 1 <= last_event_id <= self._last_id:
+            # Missed more than we remember (or we restarted): resend every lot
+            with db.engine.connect() as conn:
+                snapshots = list(_lot_snapshots(conn, with_spots=channel == 'spots').values())
+            if channel == 'counts':
+                snapshots = [_counts(snapshot) for snapshot in snapshots]
+            return [(self._last_id, json.dumps(snapshots))]
+        return [(event_id, payloads[channel]) for event_id, payloads in history
+                if event_id > last_event_id and payloads[channel] is not None]
+
+    def stream(self, last_event_id=None, channel='spots'):
+        """A text/event-stream response of ``lots`` events for one client."""
+        subscriber = self.subscribe(current_app._get_current_object(), channel)
+        backlog = self._replay(int(last_event_id), channel) if last_event_id and last_event_id.isdigit() else []
+
+        def events():
+            try:
+                yield 'retry: 3000\n\n'
+                for event_id, data in backlog:
+                    yield f'id: {event_id}\nevent: lots\ndata: {data}\n\n'
+                while subscriber in self._subscribers:
+                    try:
+                        event_id, data = subscriber.get(timeout=KEEPALIVE)
+                    except queue.Empty:
+                        yield ': keepalive\n\n'
+                        continue
+                    yield f'id: {event_id}\nevent: lots\ndata: {data}\n\n'
+            finally:
+                self.unsubscribe(subscriber)
+
+        return Response(events(), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',  # let nginx pass events through unbuffered
+        })
+
+
+broker = AvailabilityBroker()
+
+
+@on_lots_changed
+def _mark_lots_dirty(lot_ids):
+    broker.mark_dirty(lot_ids)
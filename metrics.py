@@ -0,0 +1,283 @@
+from bisect import bisect_left
+from threading import Lock
+import glob
+import json
+import os
+import time
+
+from flask import Response, current_app, g, request, abort
+from sqlalchemy import event
+
+from model import *
+from sweeper import sweep_stats
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+WRITE_INTERVAL = 1  # seconds between a worker's writes of its metrics file
+
+settings = {'directory': ''}
+_written_at = 0.0
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values = {}
+        self._lock = Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(label_values), value] for label_values, value in self._values.items()]
+
+    def render(self, workers):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        labels = ('worker',) + self.labels
+        for worker, series in workers:
+            for label_values, value in series[self.name]:
+                yield f'{self.name}{_labels(labels, [worker] + label_values)} {value}'
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = Lock()
+
+    def observe(self, seconds, *label_values):
+        i = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            series[i] += 1
+            series[-1] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(label_values), list(values)] for label_values, values in self._series.items()]
+
+    def render(self, workers):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        names = ('worker',) + self.labels
+        for worker, series in workers:
+            for label_values, values in series[self.name]:
+                label_values = [worker] + label_values
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), values):
+                    cumulative += count
+                    yield f'{self.name}_bucket{_labels(names + ("le",), label_values + [bound])} {cumulative}'
+                labels = _labels(names, label_values)
+                yield f'{self.name}_sum{labels} {values[-1]}'
+                yield f'{self.name}_count{labels} {cumulative}'
+
+
+def _gauge(name, help, samples, labels=()):
+    yield f'# HELP {name} {help}'
+    yield f'# TYPE {name} gauge'
+    for label_values, value in samples:
+        yield f'{name}{_labels(labels, label_values)} {value}'
+
+
+request_duration = Histogram('parkease_http_request_duration_seconds', 'Time spent handling a request.',
+                             ('blueprint', 'endpoint', 'method'))
+requests_total = Counter('parkease_http_requests_total', 'Requests handled, by response status.',
+                         ('blueprint', 'endpoint', 'method', 'status'))
+connection_checkout = Histogram('parkease_db_connection_checkout_seconds',
+                                'Time spent waiting to check a database connection out of the pool.')
+connection_hold = Histogram('parkease_db_connection_hold_seconds',
+                            'How long a database connection stayed checked out before it was returned.')
+spot_allocation = Histogram('parkease_spot_allocation_seconds',
+                            'Time book_parking spent finding and claiming a spot.', ('outcome',))
+
+COLLECTORS = [request_duration, requests_total, connection_checkout, connection_hold, spot_allocation]
+SWEEPER_COUNTERS = {
+    'no_shows_rejected': 'Confirmed reservations rejected as no-shows by the sweeper.',
+    'pending_expired': 'Pending requests expired by the sweeper.',
+    'spots_released': 'Spots released by the sweeper.',
+    'promoted': 'Pending requests promoted to a freed spot by the sweeper.',
+}
+
+
+def _start_timer():
+    g.metrics_started = time.perf_counter()
+
+
+def _record_request(response):
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        endpoint = request.endpoint or 'unmatched'
+        blueprint = request.blueprint or 'app'
+        request_duration.observe(time.perf_counter() - started, blueprint, endpoint, request.method)
+        requests_total.inc(blueprint, endpoint, request.method, response.status_code)
+    if settings['directory'] and time.monotonic() - _written_at > WRITE_INTERVAL:
+        _write_worker_file()
+    return response
+
+
+def _time_pool_checkouts(engine):
+    # The pool has no event before a checkout starts, so time its connect()
+    # (queue wait plus opening a new connection when it has to)
+    pool = engine.pool
+    connect = pool.connect
+
+    def timed_connect():
+        started = time.perf_counter()
+        try:
+            return connect()
+        finally:
+            connection_checkout.observe(time.perf_counter() - started)
+
+    pool.connect = timed_connect
+
+
+def _checkout(dbapi_connection, connection_record, connection_proxy):
+    connection_record.info['metrics_checked_out'] = time.perf_counter()
+
+
+def _checkin(dbapi_connection, connection_record):
+    started = connection_record.info.pop('metrics_checked_out', None)
+    if started is not None:
+        connection_hold.observe(time.perf_counter() - started)
+
+
+def _database_gauges():
+    # Both read small tables or an index range, so scraping every few seconds is cheap
+    lots = db.session.query(
+        ParkingLot.id, ParkingLot.prime_location_name, ParkingLot.free_count,
+        ParkingLot.booked_count, ParkingLot.occupied_count, ParkingLot.available_spots
+    ).order_by(ParkingLot.id).all()
+    pending = dict(db.session.query(Reservation.lot_id, func.count(Reservation.id)).filter(
+        Reservation.status == 'Pending'
+    ).group_by(Reservation.lot_id).all())
+    names = {lot.id: lot.prime_location_name or '' for lot in lots}
+
+    yield from _gauge('parkease_lot_spots', 'Spots of a lot by current state.', [
+        ((lot.id, names[lot.id], state), count) for lot in lots
+        for state, count in (('free', lot.free_count), ('booked', lot.booked_count), ('occupied', lot.occupied_count))
+    ], ('lot_id', 'lot', 'state'))
+    yield from _gauge('parkease_lot_occupancy_ratio', 'Occupied share of a lot\'s spots.', [
+        ((lot.id, names[lot.id]), round(lot.occupied_count / lot.available_spots, 4) if lot.available_spots else 0)
+        for lot in lots
+    ], ('lot_id', 'lot'))
+    yield from _gauge('parkease_pending_reservations', 'Pending requests waiting for a spot, per lot.', [
+        ((lot.id, names[lot.id]), pending.get(lot.id, 0)) for lot in lots
+    ], ('lot_id', 'lot'))
+
+
+def _worker_state():
+    # Everything this process counts itself, as plain JSON-able values
+    series = {collector.name: collector.snapshot() for collector in COLLECTORS}
+    pool = db.engine.pool
+    series['pool_checked_out'] = pool.checkedout() if hasattr(pool, 'checkedout') else None
+    series['sweeper'] = {key: sweep_stats[key] for key in (*SWEEPER_COUNTERS, 'runs', 'last_duration_seconds')}
+    return str(os.getpid()), series
+
+
+def _write_worker_file():
+    global _written_at
+    _written_at = time.monotonic()
+    worker, series = _worker_state()
+    path = os.path.join(settings['directory'], f'{worker}.json')
+    with open(f'{path}.part', 'w') as f:
+        json.dump(series, f)
+    os.replace(f'{path}.part', path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _workers():
+    """(worker, series) of every worker: just this one, or with METRICS_DIR
+    every live worker that wrote a file there."""
+    if not settings['directory']:
+        return [_worker_state()]
+    _write_worker_file()
+    workers = []
+    for path in sorted(glob.glob(os.path.join(settings['directory'], '*.json'))):
+        worker = os.path.basename(path)[:-len('.json')]
+        if not worker.isdigit() or not _alive(int(worker)):
+            # A restarted worker starts new series under its new pid
+            os.remove(path)
+            continue
+        try:
+            with open(path) as f:
+                workers.append((worker, json.load(f)))
+        except (OSError, ValueError):
+            continue
+    return workers
+
+
+def _process_gauges(workers):
+    yield from _gauge('parkease_db_pool_checked_out', 'Connections currently checked out of the pool.', [
+        ((worker,), series['pool_checked_out']) for worker, series in workers if series['pool_checked_out'] is not None
+    ], ('worker',))
+    for key, help in SWEEPER_COUNTERS.items():
+        yield f'# HELP parkease_sweeper_{key}_total {help}'
+        yield f'# TYPE parkease_sweeper_{key}_total counter'
+        for worker, series in workers:
+            yield f'parkease_sweeper_{key}_total{_labels(("worker",), (worker,))} {series["sweeper"][key]}'
+    yield from _gauge('parkease_sweeper_runs', 'Sweeper runs since the process started.', [
+        ((worker,), series['sweeper']['runs']) for worker, series in workers
+    ], ('worker',))
+    yield from _gauge('parkease_sweeper_last_duration_seconds', 'Duration of the last sweep.', [
+        ((worker,), series['sweeper']['last_duration_seconds']) for worker, series in workers
+    ], ('worker',))
+
+
+def metrics_view():
+    token = current_app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(401)
+    workers = _workers()
+    lines = []
+    for collector in COLLECTORS:
+        lines.extend(collector.render(workers))
+    lines.extend(_process_gauges(workers))
+    lines.extend(_database_gauges())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    """Time every request and serve the collected metrics at /metrics
+    in the Prometheus text format.
+
+    Request, pool and sweeper series are counted per process and carry a
+    ``worker`` (pid) label, so one worker's restart or another worker
+    answering the scrape never looks like a counter reset. With METRICS_DIR
+    set, every worker writes its series to a file there (at most once a
+    second) and /metrics reports all of them. Without it, only the worker
+    that answers is reported, so scrape each worker directly. Anyone can
+    read /metrics unless METRICS_TOKEN is set.
+    """
+    settings['directory'] = app.config['METRICS_DIR']
+    if settings['directory']:
+        os.makedirs(settings['directory'], exist_ok=True)
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
+    with app.app_context():
+        _time_pool_checkouts(db.engine)
+        # engine.dispose() swaps in a new pool (the listeners below carry over)
+        event.listen(db.engine, 'engine_disposed', _time_pool_checkouts)
+        event.listen(db.engine.pool, 'checkout', _checkout)
+        event.listen(db.engine.pool, 'checkin', _checkin)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -1,10 +1,51 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+from sqlalchemy import update, insert, delete, func, event, select, literal, union_all, exists, and_, true
+from sqlalchemy.orm.attributes import set_committed_value
 from flask_login import UserMixin
 
 db = SQLAlchemy()
 
 
+# Listeners called with the set of lot ids whose spot occupancy changed,
+# once the transaction that changed them has committed
+_lot_change_listeners = []
+
+
+def on_lots_changed(listener):
+    _lot_change_listeners.append(listener)
+    return listener
+
+
+def mark_lots_changed(*lot_ids):
+    db.session.info.setdefault('changed_lots', set()).update(lot_ids)
+
+
+@event.listens_for(db.session, 'before_commit')
+def _bump_occupancy_versions(session):
+    # One bump per changed lot per transaction, committed with the change
+    lot_ids = session.info.get('changed_lots')
+    if lot_ids:
+        session.execute(
+            update(ParkingLot).where(ParkingLot.id.in_(lot_ids))
+            .values(occupancy_version=ParkingLot.occupancy_version + 1),
+            execution_options={'synchronize_session': False}
+        )
+
+
+@event.listens_for(db.session, 'after_commit')
+def _notify_lots_changed(session):
+    lot_ids = session.info.pop('changed_lots', None)
+    if lot_ids:
+        for listener in _lot_change_listeners:
+            listener(lot_ids)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_lots_changed(session):
+    session.info.pop('changed_lots', None)
+
+
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
 
@@ -23,6 +64,11 @@ class User(db.Model, UserMixin):
 
     registration_date = db.Column(db.DateTime, default=datetime.now)
     is_active = db.Column(db.Boolean, default=True)
+
+    # Latest Flag of the user, copied here so listings need no join
+    flagged = db.Column(db.Boolean, nullable=False, default=False, server_default='0', index=True)
+    flag_reason = db.Column(db.String(200))
+    flagged_at = db.Column(db.DateTime)
     
     reservations = db.relationship('Reservation', backref='user_ref', lazy=True)
     vehicles = db.relationship('Vehicle', backref='owner', cascade='all, delete-orphan')
@@ -32,8 +78,14 @@ class User(db.Model, UserMixin):
 
     @property
     def is_flagged(self):
-        latest_flag = sorted(self.flags, key=lambda f: f.flag_date, reverse=True)
-        return latest_flag[0].is_flagged if latest_flag else False
+        return self.flagged
+
+    def refresh_flag_state(self):
+        """Copy the user's latest Flag onto the flagged/flag_reason/flagged_at columns."""
+        latest = Flag.query.filter_by(user_id=self.id).order_by(Flag.flag_date.desc(), Flag.id.desc()).first()
+        self.flagged = bool(latest and latest.is_flagged)
+        self.flag_reason = latest.reason if self.flagged else None
+        self.flagged_at = latest.flag_date if self.flagged else None
 
 
 
@@ -64,10 +116,17 @@ class ParkingLot(db.Model):
     
     is_active = db.Column(db.Boolean, default=True)
     
+    # Live spot counts, kept in step with ParkingSpot.set_status
+    occupied_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    booked_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    free_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Bumped by every commit that changes the lot or its spots; API ETags hang off it
+    occupancy_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    
     image_url = db.Column(db.String)
     admin_notes = db.Column(db.Text)
     
-    location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=False)
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=False, index=True)
         
     # Not using these as of now
     # latitude = db.Column(db.Float)
@@ -80,19 +139,187 @@ class ParkingLot(db.Model):
     def __repr__(self):
         return f'<ParkingLot {self.prime_location_name}>'
 
-    def get_available_spots(self, when=None):
-        when = when or datetime.now()
-        return sum(
-            1 for spot in self.spots
-            if spot.status == 'A' and not spot.has_conflicting_reservation(when)
+    def recount_spots(self):
+        mark_lots_changed(self.id)
+        counts = dict(db.session.query(ParkingSpot.status, func.count(ParkingSpot.id))
+                      .filter(ParkingSpot.lot_id == self.id)
+                      .group_by(ParkingSpot.status).all())
+        self.occupied_count = counts.get('O', 0)
+        self.booked_count = counts.get('B', 0)
+        self.free_count = counts.get('A', 0)
+
+    def add_spots(self, count):
+        """Append ``count`` free spots numbered after the lot's last spot.
+
+        One multi-row INSERT rather than an ORM object per spot. Returns
+        the number given to the first new spot.
+        """
+        last = db.session.query(func.max(ParkingSpot.spot_number)).filter(ParkingSpot.lot_id == self.id).scalar() or 0
+        if count > 0:
+            db.session.execute(insert(ParkingSpot), [
+                {'lot_id': self.id, 'spot_number': number, 'status': 'A', 'version': 0}
+                for number in range(last + 1, last + count + 1)
+            ])
+            db.session.info.setdefault('spot_layout_changed', set()).add(self.id)
+            self.recount_spots()
+        return last + 1
+
+    def remove_spots(self, count):
+        """Delete the ``count`` highest-numbered free spots of the lot.
+
+        Occupied, booked and unavailable (O/B/X) spots are never removed.
+        The DELETE only matches spots that are still 'A', so a booking that
+        claims one of them first makes it come up short. Returns False,
+        with nothing deleted, when there aren't ``count`` removable spots;
+        the caller should roll back.
+        """
+        if count <= 0:
+            return True
+        spot_ids = [spot_id for (spot_id,) in db.session.query(ParkingSpot.id).filter(
+            ParkingSpot.lot_id == self.id, ParkingSpot.status == 'A'
+        ).order_by(ParkingSpot.spot_number.desc()).limit(count)]
+        if len(spot_ids) < count:
+            return False
+
+        # Past bookings keep their history but lose the spot, as with ORM deletes
+        db.session.execute(
+            update(Reservation).where(Reservation.spot_id.in_(spot_ids)).values(spot_id=None),
+            execution_options={'synchronize_session': False}
+        )
+        result = db.session.execute(
+            delete(ParkingSpot).where(ParkingSpot.id.in_(spot_ids), ParkingSpot.status == 'A'),
+            execution_options={'synchronize_session': False}
         )
+        if result.rowcount != count:
+            return False
+        db.session.info.setdefault('spot_layout_changed', set()).add(self.id)
+        self.recount_spots()
+        return True
+
+    def get_available_spots(self, when=None):
+        return ParkingLot.available_spots_at([self.id], when)[self.id]
+
+    @classmethod
+    def available_spots_at(cls, lot_ids, when=None):
+        """Free spots of many lots at one or more moments, in a single query.
+
+        A spot counts when it is 'A' and no Confirmed reservation covers the
+        moment. With a single ``when`` (default now) returns
+        {lot_id: available}; with a list of timestamps returns
+        {lot_id: [available at each timestamp, in order]}.
+        """
+        single = not isinstance(when, (list, tuple))
+        moments = [when or datetime.now()] if single else list(when)
+        counts = {lot_id: [0] * len(moments) for lot_id in lot_ids}
+        if counts and moments:
+            for lot_id, position, available in db.session.execute(cls.available_spots_query(list(counts), moments)):
+                counts[lot_id][position] = available
+        return {lot_id: available[0] for lot_id, available in counts.items()} if single else counts
+
+    @staticmethod
+    def available_spots_query(lot_ids, moments):
+        """(lot_id, moment position, available) rows: spots x moments, anti-joined
+        against Confirmed reservations covering the moment."""
+        moment = union_all(*[
+            select(literal(i).label('position'), literal(at, db.DateTime).label('at'))
+            for i, at in enumerate(moments)
+        ]).cte('moment')
+        conflict = exists().where(and_(
+            Reservation.spot_id == ParkingSpot.id,
+            Reservation.status == 'Confirmed',
+            Reservation.expected_arrival <= moment.c.at,
+            Reservation.expected_departure >= moment.c.at
+        ))
+        return select(ParkingSpot.lot_id, moment.c.position, func.count(ParkingSpot.id)).join(
+            moment, true()
+        ).where(
+            ParkingSpot.lot_id.in_(lot_ids),
+            ParkingSpot.status == 'A',
+            ~conflict
+        ).group_by(ParkingSpot.lot_id, moment.c.position)
+
+
+class SpotClaimConflict(Exception):
+    """Another transaction changed the parking spot since we read it."""
+
+    def __init__(self, spot_id):
+        super().__init__(f'Parking spot {spot_id} was changed by another request')
+        self.spot_id = spot_id
 
 
 class ParkingSpot(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     lot_id = db.Column(db.Integer, db.ForeignKey('parking_lot.id'))
     spot_number = db.Column(db.Integer, nullable=False)
-    status = db.Column(db.String(1), default='A')  # A = Available, O = Occupied
+    status = db.Column(db.String(1), default='A')  # A = Available, B = Booked, O = Occupied, X = Unavailable
+    # Bumped by every status write; claims compare-and-set against it
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    COUNTERS = {'A': 'free_count', 'B': 'booked_count', 'O': 'occupied_count'}
+    CLAIM_ATTEMPTS = 3
+
+    __table_args__ = (
+        # Per-lot status counts and free-spot lookups
+        db.Index('ix_parking_spot_lot_status', 'lot_id', 'status'),
+        # Spot grids ordered by number, and lookups by (lot, number)
+        db.Index('ix_parking_spot_lot_number', 'lot_id', 'spot_number'),
+    )
+
+    def claim(self, new_status, expected=None):
+        """Compare-and-set the spot status against the version we last read.
+
+        The UPDATE only matches while the row still has our version (and one
+        of the ``expected`` statuses, if given), so of two requests racing
+        for the same spot exactly one wins; the other gets SpotClaimConflict.
+        The version moves even when the status doesn't, which lets a booking
+        fence off concurrent bookings of an already booked spot.
+        """
+        conditions = [ParkingSpot.id == self.id, ParkingSpot.version == self.version]
+        if expected is not None:
+            conditions.append(ParkingSpot.status.in_(expected))
+        result = db.session.execute(
+            update(ParkingSpot).where(*conditions).values(status=new_status, version=ParkingSpot.version + 1),
+            execution_options={'synchronize_session': False}
+        )
+        if result.rowcount != 1:
+            raise SpotClaimConflict(self.id)
+
+        old_status = self.status
+        set_committed_value(self, 'status', new_status)
+        set_committed_value(self, 'version', self.version + 1)
+        if old_status == new_status:
+            return
+
+        values = {}
+        if old_status in self.COUNTERS:
+            column = self.COUNTERS[old_status]
+            values[column] = getattr(ParkingLot, column) - 1
+        if new_status in self.COUNTERS:
+            column = self.COUNTERS[new_status]
+            values[column] = getattr(ParkingLot, column) + 1
+        if values:
+            db.session.execute(update(ParkingLot).where(ParkingLot.id == self.lot_id).values(**values))
+        mark_lots_changed(self.lot_id)
+        if 'X' in (old_status, new_status):
+            # Soft deletes change which spots the lot's interval index holds
+            db.session.info.setdefault('spot_layout_changed', set()).add(self.lot_id)
+
+    def set_status(self, new_status, expected=None):
+        """Move the spot to ``new_status`` and the lot counters with it.
+
+        Lost races are retried against the freshly read row, up to
+        CLAIM_ATTEMPTS times. Returns False, changing nothing, when the spot
+        is no longer in one of the ``expected`` statuses.
+        """
+        for _ in range(self.CLAIM_ATTEMPTS):
+            if expected is not None and self.status not in expected:
+                return False
+            try:
+                self.claim(new_status, expected)
+                return True
+            except SpotClaimConflict:
+                db.session.refresh(self, ['status', 'version'])
+        raise SpotClaimConflict(self.id)
 
     def has_conflicting_reservation(self, when):
         return bool(Reservation.query.filter(
@@ -120,12 +347,29 @@ class Reservation(db.Model):
     parking_cost = db.Column(db.Float)
     status = db.Column(db.String(20), default='Pending')
     cancellation_reason = db.Column(db.String(200))
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
 
     lot = db.relationship('ParkingLot')
     spot = db.relationship('ParkingSpot', backref=db.backref('reservations', lazy='dynamic'))
     user = db.relationship('User', overlaps="reservations,user_ref")
     vehicle = db.relationship('Vehicle')
 
+    __table_args__ = (
+        # Per-lot waitlist: Pending requests of a lot in arrival order
+        db.Index('ix_reservation_waitlist', 'lot_id', 'status', 'expected_arrival'),
+        # A user's bookings by state, soonest first (dashboard, bookings, stats)
+        db.Index('ix_reservation_user_status', 'user_id', 'status', 'expected_arrival'),
+        # A user's parking history, most recent departure first
+        db.Index('ix_reservation_user_left', 'user_id', 'leaving_timestamp'),
+        # Overlap checks and history of a single spot
+        db.Index('ix_reservation_spot_status', 'spot_id', 'status', 'expected_arrival'),
+        # No-show sweeps and status-wide reports
+        db.Index('ix_reservation_status_arrival', 'status', 'expected_arrival'),
+        db.Index('ix_reservation_parked_at', 'parking_timestamp'),
+        db.Index('ix_reservation_booked_at', 'booking_timestamp'),
+        db.Index('ix_reservation_updated_at', 'updated_at'),
+    )
+
 
 
 class Vehicle(db.Model):
@@ -135,7 +379,7 @@ class Vehicle(db.Model):
     license_plate = db.Column(db.String(20), unique=True, nullable=False)
     vehicle_image = db.Column(db.String)
     color = db.Column(db.String(50))
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
 
     # Relationship - using back_populates instead of backref
     reservations = db.relationship('Reservation', back_populates='vehicle', lazy=True)
@@ -151,13 +395,15 @@ class Favorite(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)  
 
     user = db.relationship('User', backref='favorites')
+
+    __table_args__ = (db.Index('ix_favorite_user_lot', 'user_id', 'lot_id'),)
     lot = db.relationship('ParkingLot', backref='favorites')
 
 
 
 class Review(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    reservation_id = db.Column(db.Integer, db.ForeignKey('reservation.id'))
+    reservation_id = db.Column(db.Integer, db.ForeignKey('reservation.id'), index=True)
     rating = db.Column(db.Integer)
     comment = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -174,3 +420,63 @@ class Flag(db.Model):
     is_flagged = db.Column(db.Boolean, default=False)
     
     user = db.relationship('User', backref='flags')
+
+    # Latest flag of a user
+    __table_args__ = (db.Index('ix_flag_user_date', 'user_id', 'flag_date'),)
+
+
+
+class ReservationRollup(db.Model):
+    # Reservation totals per lot and hour of expected arrival (see rollups.py)
+    lot_id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    hour = db.Column(db.Integer, primary_key=True)
+
+    bookings = db.Column(db.Integer, nullable=False, default=0)
+    arrivals = db.Column(db.Integer, nullable=False, default=0)
+    departures = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+
+    # Parking duration histogram of completed reservations
+    duration_lt_1h = db.Column(db.Integer, nullable=False, default=0)
+    duration_1_2h = db.Column(db.Integer, nullable=False, default=0)
+    duration_2_4h = db.Column(db.Integer, nullable=False, default=0)
+    duration_4_8h = db.Column(db.Integer, nullable=False, default=0)
+    duration_8h_plus = db.Column(db.Integer, nullable=False, default=0)
+
+    # Current status breakdown
+    pending = db.Column(db.Integer, nullable=False, default=0)
+    confirmed = db.Column(db.Integer, nullable=False, default=0)
+    parked = db.Column(db.Integer, nullable=False, default=0)
+    parked_out = db.Column(db.Integer, nullable=False, default=0)
+    cancelled_rejected = db.Column(db.Integer, nullable=False, default=0)
+
+
+
+class UserReservationRollup(db.Model):
+    # Per-user reservation counts and spend behind the user /stats page
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    lot_id = db.Column(db.Integer)
+    vehicle_id = db.Column(db.Integer)
+    status = db.Column(db.String(20))
+    has_spot = db.Column(db.Boolean, nullable=False)
+
+    reservations = db.Column(db.Integer, nullable=False, default=0)
+    spend = db.Column(db.Float, nullable=False, default=0)
+
+
+
+class RollupState(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    watermark = db.Column(db.DateTime)
+    refreshed_at = db.Column(db.DateTime)
+
+
+
+class RollupDirtyKey(db.Model):
+    # Buckets touched by deleted reservations, folded in on the next refresh
+    id = db.Column(db.Integer, primary_key=True)
+    lot_id = db.Column(db.Integer)
+    day = db.Column(db.Date)
+    user_id = db.Column(db.Integer)
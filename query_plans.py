@@ -0,0 +1,146 @@
+from datetime import datetime, timedelta
+import random
+
+from sqlalchemy import create_engine, select, insert, or_, exists, and_
+
+from model import *
+
+# The queries behind the busiest routes, as (name, statement builder).
+# Keep these in step with the routes when their filters change.
+HOT_QUERIES = [
+    ('user dashboard: current parking', lambda now: select(Reservation.id).where(
+        Reservation.user_id == 1, Reservation.leaving_timestamp.is_(None), Reservation.status == 'Parked')),
+    ('user dashboard: next booking', lambda now: select(Reservation.id).where(
+        Reservation.user_id == 1, Reservation.status == 'Confirmed',
+        Reservation.parking_timestamp.is_(None), Reservation.expected_arrival > now
+    ).order_by(Reservation.expected_arrival).limit(1)),
+    ('user bookings: history', lambda now: select(Reservation.id).where(
+        Reservation.user_id == 1, Reservation.leaving_timestamp.isnot(None), Reservation.status == 'Parked Out'
+    ).order_by(Reservation.leaving_timestamp.desc()).limit(20)),
+    ('user bookings: cancelled', lambda now: select(Reservation.id).where(
+        Reservation.user_id == 1, Reservation.status.in_(['Cancelled', 'Rejected']))),
+    ('user stats: status counts', lambda now: select(Reservation.status, func.count(Reservation.id)).where(
+        Reservation.user_id == 1).group_by(Reservation.status)),
+    ('book: overlapping bookings of a spot', lambda now: select(Reservation.id).where(
+        Reservation.spot_id == 1, Reservation.status.in_(['Pending', 'Confirmed', 'Parked']),
+        Reservation.expected_arrival < now + timedelta(hours=2), Reservation.expected_departure > now)),
+    ('book: spot counts of a lot', lambda now: select(ParkingSpot.status, func.count(ParkingSpot.id)).where(
+        ParkingSpot.lot_id == 1).group_by(ParkingSpot.status)),
+    ('book: free spot of a lot', lambda now: select(ParkingSpot.id).where(
+        ParkingSpot.lot_id == 1, ParkingSpot.status == 'A').limit(1)),
+    ('spot index: blocking bookings of a lot', lambda now: select(Reservation.id).join(
+        ParkingSpot, ParkingSpot.id == Reservation.spot_id
+    ).where(ParkingSpot.lot_id == 1, Reservation.status.in_(['Pending', 'Confirmed', 'Parked']))),
+    ('spot index: free spot of a lot in the database', lambda now: select(ParkingSpot.id).where(
+        ParkingSpot.lot_id == 1, ParkingSpot.status != 'X', ~exists().where(and_(
+            Reservation.spot_id == ParkingSpot.id, Reservation.status.in_(['Pending', 'Confirmed', 'Parked']),
+            Reservation.expected_arrival < now + timedelta(hours=2), Reservation.expected_departure > now))
+    ).order_by(ParkingSpot.id).limit(1)),
+    ('waitlist: pending requests of a lot', lambda now: select(Reservation.id).where(
+        Reservation.lot_id == 1, Reservation.status == 'Pending',
+        Reservation.expected_arrival <= now, Reservation.spot_id.is_(None)
+    ).order_by(Reservation.expected_arrival).limit(5)),
+    ('sweeper: no-shows', lambda now: select(Reservation.id).where(
+        Reservation.status == 'Confirmed', Reservation.parking_timestamp.is_(None),
+        Reservation.expected_arrival < now - timedelta(minutes=30)).limit(500)),
+    ('admin view spot: last booking', lambda now: select(Reservation.id).where(
+        Reservation.spot_id == 1).order_by(Reservation.expected_arrival.desc()).limit(1)),
+    ('admin view spot: by number', lambda now: select(ParkingSpot.id).where(
+        ParkingSpot.lot_id == 1, ParkingSpot.spot_number == 3)),
+    ('admin spot grid', lambda now: select(ParkingSpot.id).where(
+        ParkingSpot.lot_id == 1).order_by(ParkingSpot.spot_number)),
+    ('admin kpis: parked today', lambda now: select(func.count(Reservation.id)).where(
+        Reservation.parking_timestamp >= now.replace(hour=0, minute=0, second=0, microsecond=0))),
+    ('admin edit lot: live bookings', lambda now: select(func.count(Reservation.id)).join(
+        ParkingSpot, ParkingSpot.id == Reservation.spot_id
+    ).where(ParkingSpot.lot_id == 1, Reservation.status.in_(['Confirmed', 'Pending', 'Parked']))),
+    ('admin activity log', lambda now: select(Reservation.id).order_by(
+        Reservation.booking_timestamp.desc(), Reservation.id.desc()).limit(51)),
+    ('admin activity log: next page', lambda now: select(Reservation.id).where(
+        Reservation.booking_timestamp <= now,
+        or_(Reservation.booking_timestamp < now, Reservation.id < 1000)
+    ).order_by(Reservation.booking_timestamp.desc(), Reservation.id.desc()).limit(51)),
+    ('admin user flags', lambda now: select(Flag.id).where(
+        Flag.user_id == 1).order_by(Flag.flag_date.desc()).limit(1)),
+    ('admin flagged users', lambda now: select(User.id, User.flag_reason).where(User.flagged == True)),
+    ('admin lots of a location', lambda now: select(ParkingLot.id).where(ParkingLot.location_id == 1)),
+    ('user vehicles', lambda now: select(Vehicle.id).where(Vehicle.user_id == 1)),
+    ('user favourite', lambda now: select(Favorite.id).where(Favorite.user_id == 1, Favorite.lot_id == 1)),
+    ('availability of many lots over time', lambda now: ParkingLot.available_spots_query([1, 2, 3], [now, now + timedelta(hours=1)])),
+    ('rollups: changed reservations', lambda now: select(Reservation.lot_id, Reservation.user_id).where(
+        Reservation.updated_at >= now - timedelta(minutes=5))),
+]
+
+
+def seed(conn, lots=8, spots_per_lot=40, users=60, reservations=4000):
+    """Fill an empty schema with enough synthetic rows for realistic plans."""
+    rng = random.Random(42)
+    now = datetime.now()
+    conn.execute(insert(Location), [{'id': 1, 'name': 'Seed', 'address': 'Seed'}])
+    conn.execute(insert(ParkingLot), [
+        {'id': lot_id, 'location_id': 1, 'prime_location_name': f'Lot {lot_id}', 'price_per_hour': 20,
+         'max_parking_spots': spots_per_lot, 'available_spots': spots_per_lot}
+        for lot_id in range(1, lots + 1)
+    ])
+    conn.execute(insert(ParkingSpot), [
+        {'lot_id': lot_id, 'spot_number': number, 'status': rng.choice('AAABOX')}
+        for lot_id in range(1, lots + 1) for number in range(1, spots_per_lot + 1)
+    ])
+    conn.execute(insert(User), [
+        {'id': user_id, 'email': f'user{user_id}@example.com', 'password': '-', 'flagged': user_id % 20 == 0}
+        for user_id in range(1, users + 1)
+    ])
+    conn.execute(insert(Vehicle), [
+        {'id': user_id, 'user_id': user_id, 'license_plate': f'SEED{user_id}'}
+        for user_id in range(1, users + 1)
+    ])
+    rows = []
+    for i in range(reservations):
+        arrival = now + timedelta(hours=rng.randint(-24 * 90, 24 * 7))
+        status = rng.choice(['Pending', 'Confirmed', 'Parked', 'Parked Out', 'Parked Out', 'Cancelled', 'Rejected'])
+        parked = arrival if status in ('Parked', 'Parked Out') else None
+        rows.append({
+            'booking_id': f'SEED-{i}', 'lot_id': rng.randint(1, lots),
+            'spot_id': None if status == 'Pending' else rng.randint(1, lots * spots_per_lot),
+            'user_id': rng.randint(1, users), 'vehicle_id': rng.randint(1, users),
+            'expected_arrival': arrival, 'expected_departure': arrival + timedelta(hours=rng.randint(1, 8)),
+            'parking_timestamp': parked,
+            'leaving_timestamp': parked + timedelta(hours=2) if status == 'Parked Out' else None,
+            'status': status, 'booking_timestamp': arrival - timedelta(days=1), 'updated_at': arrival,
+        })
+    conn.execute(insert(Reservation), rows)
+    conn.execute(insert(Flag), [
+        {'user_id': rng.randint(1, users), 'reason': 'seed', 'flag_date': now - timedelta(days=i), 'is_flagged': True}
+        for i in range(30)
+    ])
+    conn.execute(insert(Favorite), [
+        {'user_id': user_id, 'lot_id': rng.randint(1, lots)} for user_id in range(1, users + 1)
+    ])
+    conn.exec_driver_sql('ANALYZE')
+
+
+def full_scans(plan):
+    # "SCAN reservation" walks the whole table; "SCAN ... USING INDEX" is an
+    # ordered index walk, which the LIMIT queries rely on. Scans of CTEs and
+    # constant rows are fine.
+    return [detail for detail in plan
+            if detail.startswith('SCAN ') and ' USING ' not in detail
+            and detail.split()[1] in db.metadata.tables]
+
+
+def check_query_plans(engine=None):
+    """EXPLAIN QUERY PLAN every hot query on a seeded in-memory SQLite database.
+
+    Returns a list of (name, plan lines, full scan lines), one per query.
+    """
+    engine = engine or create_engine('sqlite://')
+    now = datetime.now()
+    db.metadata.create_all(engine)
+    results = []
+    with engine.begin() as conn:
+        seed(conn)
+        for name, build in HOT_QUERIES:
+            sql = str(build(now).compile(engine, compile_kwargs={'literal_binds': True}))
+            plan = [row[-1] for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql)]
+            results.append((name, plan, full_scans(plan)))
+    return results
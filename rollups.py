@@ -0,0 +1,224 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, extract, case, and_, tuple_, delete, insert, select
+
+from model import *
+
+STATE_NAME = 'reservations'
+
+# Rows committed a little after their updated_at was stamped are still picked
+# up, since each refresh re-reads this much history before the watermark.
+WATERMARK_OVERLAP = timedelta(minutes=2)
+
+
+def _completed(expr):
+    return case((and_(Reservation.leaving_timestamp.isnot(None),
+                      Reservation.parking_timestamp.isnot(None), expr), 1), else_=0)
+
+
+def _lot_hour_select():
+    duration_hours = func.round(
+        (func.julianday(Reservation.leaving_timestamp) - func.julianday(Reservation.parking_timestamp)) * 24, 2
+    )
+    day = func.date(Reservation.expected_arrival)
+    hour = extract('hour', Reservation.expected_arrival)
+
+    def status_is(*statuses):
+        return func.sum(case((Reservation.status.in_(statuses), 1), else_=0))
+
+    columns = [
+        Reservation.lot_id.label('lot_id'),
+        day.label('day'),
+        hour.label('hour'),
+        func.count(Reservation.id).label('bookings'),
+        func.sum(case((Reservation.parking_timestamp.isnot(None), 1), else_=0)).label('arrivals'),
+        func.sum(case((Reservation.leaving_timestamp.isnot(None), 1), else_=0)).label('departures'),
+        func.coalesce(func.sum(case((Reservation.status == 'Parked Out', Reservation.parking_cost), else_=0)), 0).label('revenue'),
+        func.sum(_completed(duration_hours < 1)).label('duration_lt_1h'),
+        func.sum(_completed(and_(duration_hours >= 1, duration_hours < 2))).label('duration_1_2h'),
+        func.sum(_completed(and_(duration_hours >= 2, duration_hours < 4))).label('duration_2_4h'),
+        func.sum(_completed(and_(duration_hours >= 4, duration_hours < 8))).label('duration_4_8h'),
+        func.sum(_completed(duration_hours >= 8)).label('duration_8h_plus'),
+        status_is('Pending').label('pending'),
+        status_is('Confirmed').label('confirmed'),
+        status_is('Parked').label('parked'),
+        status_is('Parked Out').label('parked_out'),
+        status_is('Cancelled', 'Rejected').label('cancelled_rejected'),
+    ]
+    return select(*columns).group_by(Reservation.lot_id, day, hour), day
+
+
+def _user_select():
+    # Spot-based charts only count reservations whose spot still exists,
+    # attributed to that spot's lot, as the live queries do
+    has_spot = ParkingSpot.id.isnot(None)
+    lot_id = case((has_spot, ParkingSpot.lot_id), else_=Reservation.lot_id)
+    columns = [
+        Reservation.user_id.label('user_id'),
+        lot_id.label('lot_id'),
+        Reservation.vehicle_id.label('vehicle_id'),
+        Reservation.status.label('status'),
+        has_spot.label('has_spot'),
+        func.count(Reservation.id).label('reservations'),
+        func.coalesce(func.sum(Reservation.parking_cost), 0).label('spend'),
+    ]
+    return select(*columns).outerjoin(ParkingSpot, ParkingSpot.id == Reservation.spot_id).where(
+        Reservation.user_id.isnot(None)
+    ).group_by(Reservation.user_id, lot_id, Reservation.vehicle_id, Reservation.status, has_spot)
+
+
+def _insert_from(model, query):
+    columns = [c.name for c in query.selected_columns]
+    db.session.execute(insert(model).from_select(columns, query))
+
+
+def backfill_rollups():
+    """Rebuild every rollup row from the full reservation history."""
+    started = datetime.now()
+    db.session.execute(delete(ReservationRollup))
+    db.session.execute(delete(UserReservationRollup))
+    db.session.execute(delete(RollupDirtyKey))
+
+    lot_hour, _ = _lot_hour_select()
+    _insert_from(ReservationRollup, lot_hour)
+    _insert_from(UserReservationRollup, _user_select())
+
+    _save_state(started)
+    db.session.commit()
+
+
+def refresh_rollups():
+    """Fold reservations changed since the last watermark into the rollups.
+
+    Only the (lot, day) buckets and users touched by those rows are
+    recomputed. Returns the number of buckets rebuilt, or None when there
+    was no watermark yet and a full backfill ran instead.
+    """
+    state = db.session.get(RollupState, STATE_NAME)
+    if state is None or state.watermark is None:
+        backfill_rollups()
+        return None
+
+    started = datetime.now()
+    since = state.watermark - WATERMARK_OVERLAP
+    arrival_day = func.date(Reservation.expected_arrival)
+
+    changed = db.session.query(Reservation.lot_id, arrival_day, Reservation.user_id).filter(
+        Reservation.updated_at >= since
+    ).distinct().all()
+    dirty = db.session.query(RollupDirtyKey.lot_id, RollupDirtyKey.day, RollupDirtyKey.user_id).all()
+
+    lot_days = {(lot_id, str(day)) for lot_id, day, _ in changed + dirty if lot_id is not None and day is not None}
+    user_ids = {user_id for _, _, user_id in changed + dirty if user_id is not None}
+
+    if lot_days:
+        keys = list(lot_days)
+        db.session.execute(delete(ReservationRollup).where(
+            tuple_(ReservationRollup.lot_id, func.date(ReservationRollup.day)).in_(keys)
+        ))
+        lot_hour, day = _lot_hour_select()
+        _insert_from(ReservationRollup, lot_hour.where(tuple_(Reservation.lot_id, day).in_(keys)))
+
+    if user_ids:
+        db.session.execute(delete(UserReservationRollup).where(UserReservationRollup.user_id.in_(user_ids)))
+        _insert_from(UserReservationRollup, _user_select().where(Reservation.user_id.in_(user_ids)))
+
+    db.session.execute(delete(RollupDirtyKey))
+    _save_state(started)
+    db.session.commit()
+    return len(lot_days) + len(user_ids)
+
+
+def _save_state(watermark):
+    state = db.session.get(RollupState, STATE_NAME) or RollupState(name=STATE_NAME)
+    state.watermark = watermark
+    state.refreshed_at = datetime.now()
+    db.session.add(state)
+
+
+def rollups_are_fresh(max_age):
+    state = db.session.get(RollupState, STATE_NAME)
+    return bool(state and state.refreshed_at and
+                datetime.now() - state.refreshed_at <= timedelta(seconds=max_age))
+
+
+def admin_chart_counts(today):
+    """Counts behind the admin statistics charts, read from the rollups.
+
+    Returns (hourly counts, {iso day: bookings} for the last 7 days,
+    duration histogram for the last week, status breakdown).
+    """
+    hourly = [0] * 24
+    for hour, bookings in db.session.query(
+        ReservationRollup.hour, func.sum(ReservationRollup.bookings)
+    ).group_by(ReservationRollup.hour):
+        hourly[hour] = bookings
+
+    daily = {str(day): bookings for day, bookings in db.session.query(
+        ReservationRollup.day, func.sum(ReservationRollup.bookings)
+    ).filter(
+        ReservationRollup.day >= today - timedelta(days=6),
+        ReservationRollup.day <= today
+    ).group_by(ReservationRollup.day)}
+
+    durations = db.session.query(
+        func.sum(ReservationRollup.duration_lt_1h),
+        func.sum(ReservationRollup.duration_1_2h),
+        func.sum(ReservationRollup.duration_2_4h),
+        func.sum(ReservationRollup.duration_4_8h),
+        func.sum(ReservationRollup.duration_8h_plus)
+    ).filter(ReservationRollup.day >= today - timedelta(days=7)).one()
+
+    statuses = db.session.query(
+        func.sum(ReservationRollup.pending),
+        func.sum(ReservationRollup.parked),
+        func.sum(ReservationRollup.confirmed),
+        func.sum(ReservationRollup.parked_out),
+        func.sum(ReservationRollup.cancelled_rejected)
+    ).one()
+    status_data = dict(zip(['pending', 'parked', 'confirmed', 'parked_out', 'cancelled_rejected'],
+                           [count or 0 for count in statuses]))
+
+    return hourly, daily, [count or 0 for count in durations], status_data
+
+
+def user_chart_rows(user_id):
+    """Per-user rollup rows as (status counts, spending, frequency, vehicle usage)."""
+    statuses = dict(db.session.query(
+        UserReservationRollup.status, func.sum(UserReservationRollup.reservations)
+    ).filter(UserReservationRollup.user_id == user_id).group_by(UserReservationRollup.status).all())
+
+    spending = db.session.query(
+        ParkingLot.prime_location_name,
+        func.sum(UserReservationRollup.spend)
+    ).join(ParkingLot, ParkingLot.id == UserReservationRollup.lot_id).filter(
+        UserReservationRollup.user_id == user_id,
+        UserReservationRollup.has_spot.is_(True),
+        UserReservationRollup.status == 'Parked Out'
+    ).group_by(ParkingLot.id).all()
+
+    frequent = db.session.query(
+        ParkingLot.prime_location_name,
+        func.sum(UserReservationRollup.reservations)
+    ).join(ParkingLot, ParkingLot.id == UserReservationRollup.lot_id).filter(
+        UserReservationRollup.user_id == user_id,
+        UserReservationRollup.has_spot.is_(True)
+    ).group_by(ParkingLot.id).order_by(func.sum(UserReservationRollup.reservations).desc()).all()
+
+    vehicles = db.session.query(
+        Vehicle.vehicle_name,
+        func.sum(UserReservationRollup.reservations)
+    ).join(Vehicle, Vehicle.id == UserReservationRollup.vehicle_id).filter(
+        UserReservationRollup.user_id == user_id
+    ).group_by(Vehicle.id).order_by(func.sum(UserReservationRollup.reservations).desc()).all()
+
+    return statuses, spending, frequent, vehicles
+
+
+@event.listens_for(db.session, 'before_flush')
+def _record_deleted_reservations(session, flush_context, instances):
+    # Deleted rows leave no updated_at behind, so remember their buckets
+    for obj in session.deleted:
+        if isinstance(obj, Reservation) and obj.expected_arrival is not None:
+            session.add(RollupDirtyKey(lot_id=obj.lot_id, day=obj.expected_arrival.date(),
+                                       user_id=obj.user_id))
@@ -1,4 +1,5 @@
 from .admin_routes import admin_bp
 from .user_routes import user_bp
+from .api_routes import api_bp
 
-__all__ = ['admin_bp', 'user_bp']
+__all__ = ['admin_bp', 'user_bp', 'api_bp']
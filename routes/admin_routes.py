@@ -1,16 +1,30 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, session
+from flask import Blueprint, render_template, redirect, url_for, flash, request, session, jsonify, abort
+from markupsafe import Markup
 from model import *
-from werkzeug.utils import secure_filename
 from datetime import datetime, timedelta
 from sqlalchemy import or_
+from sqlalchemy.orm import joinedload, selectinload
 from werkzeug.security import generate_password_hash, check_password_hash
-from collections import Counter
 from datetime import datetime
 import os
-from flask import current_app
+from flask import current_app, Response, stream_with_context
+from sqlalchemy import event, extract, case
+from cache import TTLCache
+from rollups import rollups_are_fresh, admin_chart_counts
+import search_index
+from live import broker
+from images import save_upload, remove_upload
+from exports import FORMATS, reservation_filters, export_reservations
+import sql_profiler
+from user_cache import user_cache
+from .api_routes import version_cache
 
 admin_bp= Blueprint('admin', __name__)
 
+kpi_cache = TTLCache(maxsize=1)
+# lot id -> (render key, HTML of the lot's dashboard card)
+card_cache = TTLCache(maxsize=4096, ttl=3600)
+
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "admin")
 ADMIN_PASSWORD_HASH = generate_password_hash(os.getenv("ADMIN_PASSWORD", "admin"))
 
@@ -22,6 +36,71 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
 
+def compute_admin_kpis():
+    today = datetime.today().date()
+    vehicles_parked_today = Reservation.query.filter(Reservation.parking_timestamp >= datetime.combine(today, datetime.min.time())).count()
+    active_users = User.query.filter_by(is_active=True).count()
+    lots = ParkingLot.query.order_by(ParkingLot.id).all()
+
+    parking_lots = []
+    total_occupied_spots = 0
+    total_spots = 0
+
+    for lot in lots:
+        occupied_count = lot.occupied_count
+        total = lot.available_spots or 1
+
+        total_occupied_spots += occupied_count
+        total_spots += total
+
+        utilization = (occupied_count / total) * 100
+        parking_lots.append({
+            'id': lot.id,
+            'prime_location_name': lot.prime_location_name,
+            'is_active': lot.is_active,
+            'available_spots': lot.available_spots,
+            'max_parking_spots': lot.max_parking_spots,
+            'occupied_spots': occupied_count,
+            'utilization_rate': round(utilization, 1)
+        })
+
+    overall_utilization = round((total_occupied_spots / total_spots) * 100, 1) if total_spots else 0
+
+    return {
+        'active_users': active_users,
+        'parking_lots': parking_lots,
+        'active_parkings': sum(1 for lot in lots if lot.is_active),
+        'total_parking_lots': len(lots),
+        'utilization_rate': overall_utilization,
+        'vehicles_parked_today': vehicles_parked_today,
+        'occupied_spots': total_occupied_spots,
+        'total_spots': total_spots,
+    }
+
+
+def get_admin_kpis():
+    """Header numbers shared by the admin pages, cached for ADMIN_KPI_TTL seconds."""
+    return kpi_cache.get_or_set('kpis', compute_admin_kpis, ttl=current_app.config['ADMIN_KPI_TTL'])
+
+
+@event.listens_for(db.session, 'after_flush')
+def _mark_kpis_stale(session, flush_context):
+    changed = list(session.new) + list(session.dirty) + list(session.deleted)
+    if any(isinstance(obj, (Reservation, ParkingSpot, ParkingLot, User)) for obj in changed):
+        session.info['kpis_stale'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_kpis(session):
+    if session.info.pop('kpis_stale', False):
+        kpi_cache.clear()
+
+
+@on_lots_changed
+def _invalidate_kpis_for_lots(lot_ids):
+    kpi_cache.clear()
+
+
 @admin_bp.route('/login', methods=['GET', 'POST'])
 def admin_login():
 
@@ -41,29 +120,11 @@ def admin_login():
 
 
 
-@admin_bp.route('/dashboard/search', methods=['GET'])
-def admin_search():
-    query = request.args.get('query')
+SEARCH_PAGE_SIZE = 25
 
-    # Convert the query to lowercase to make the search case-insensitive
-    query_lower = query.lower()
-    
-    locations = Location.query.all()
-    location_count = Location.query.count()
-    
-    total_users = User.query.count()
-    
-
-    reservation_count = Reservation.query.count()
-    reservations = Reservation.query.all()
-    
-    pending_bookings = Reservation.query.filter_by(status='Pending').count()
-    confirmed_bookings = Reservation.query.filter_by(status='Confirmed').count()
-    cancelled_rejected_bookings = Reservation.query.filter(
-        or_(Reservation.status == 'Reject', Reservation.status == 'Cancelled')
-    ).count()    
-    parked_out = Reservation.query.filter_by(status='Parked Out').count()
 
+def ilike_search(query):
+    # Fallback for databases without the FTS5 search index
     results = {
         'users': User.query.filter(
             (User.firstname.ilike(f'%{query}%')) |
@@ -96,71 +157,96 @@ def admin_search():
                 'entity': entity,
                 'result': item
             })
+    return flat_results
 
-    return render_template('admin/search.html',
-                           results=flat_results,
-                           query=query,
-                           locations=locations,
-                           location_count=location_count,
-                           total_users=total_users,
-                           reservations=reservations,
-                           reservation_count=reservation_count,
-                           pending_bookings=pending_bookings,
-                           confirmed_bookings=confirmed_bookings,
-                           cancelled_rejected_bookings=cancelled_rejected_bookings,
-                           parked_out=parked_out)
 
+@admin_bp.route('/dashboard/search', methods=['GET'])
+def admin_search():
+    query = request.args.get('query', '')
+    page = max(1, request.args.get('page', 1, type=int))
 
+    if search_index.is_enabled():
+        results, total = search_index.search(query, page=page, per_page=SEARCH_PAGE_SIZE)
+    else:
+        results = ilike_search(query)
+        total = len(results)
+        results = results[(page - 1) * SEARCH_PAGE_SIZE:page * SEARCH_PAGE_SIZE]
 
+    total_pages = max(1, -(-total // SEARCH_PAGE_SIZE))
 
-@admin_bp.route('/admin_dashboard', methods=['GET'])
-def admin_dashboard():
-    # Get the current date (today)
-    today = datetime.today().date()
-
-    # Count the number of reservations (vehicles parked) today
-    vehicles_parked_today = Reservation.query.filter(Reservation.parking_timestamp >= datetime.combine(today, datetime.min.time())).count()
+    return render_template('admin/search.html',
+                           results=results,
+                           query=query,
+                           page=page,
+                           total=total,
+                           total_pages=total_pages)
 
-    # Get all parking lots and other info as before
-    lots = ParkingLot.query.order_by(ParkingLot.is_active.desc()).all()
 
-    parking_lots = []
 
-    total_occupied_spots = 0
-    total_spots = 0
 
+@admin_bp.route('/admin_dashboard', methods=['GET'])
+def admin_dashboard():
+    kpis = get_admin_kpis()
+
+    # Active lots first. Each card is re-rendered only when its lot's
+    # occupancy version (or what the card shows of the lot) moved.
+    lots = sorted(ParkingLot.query.order_by(ParkingLot.id).all(), key=lambda lot: not lot.is_active)
+    keys = {lot.id: (lot.occupancy_version, lot.prime_location_name, lot.is_active, lot.available_spots, lot.occupied_count)
+            for lot in lots}
+    cards = {}
     for lot in lots:
-        occupied_count = ParkingSpot.query.filter_by(lot_id=lot.id, status='O').count()
-        spots = ParkingSpot.query.filter_by(lot_id=lot.id).order_by(ParkingSpot.spot_number).all()
-
-        total = lot.available_spots or 1
-
-        total_occupied_spots += occupied_count
-        total_spots += total
-
-        utilization = (occupied_count / total) * 100
-        parking_lots.append({
-            'id': lot.id,
-            'spots': spots,
-            'prime_location_name': lot.prime_location_name,
-            'available_spots': lot.available_spots,
-            'occupied_spots': occupied_count,
-            'utilization_rate': round(utilization, 1)
-        })
-
-    overall_utilization = round((total_occupied_spots / total_spots) * 100, 1) if total_spots else 0
-
-    active_users = User.query.filter_by(is_active=True).count()
-    total_parking_lots = ParkingLot.query.count()
-    active_parkings = ParkingLot.query.filter_by(is_active=True).count()
-
-    return render_template('admin/dashboard.html', 
-                           active_users=active_users,
-                           parking_lots=parking_lots, 
-                           active_parkings=active_parkings, 
-                           total_parking_lots=total_parking_lots,
-                           utilization_rate=overall_utilization,
-                           vehicles_parked_today=vehicles_parked_today)
+        cached = card_cache.get(lot.id)
+        if cached is not None and cached[0] == keys[lot.id]:
+            cards[lot.id] = cached[1]
+
+    stale = [lot.id for lot in lots if lot.id not in cards]
+    spots = {}
+    if stale:
+        for spot in ParkingSpot.query.filter(ParkingSpot.lot_id.in_(stale)).order_by(ParkingSpot.lot_id, ParkingSpot.spot_number):
+            spots.setdefault(spot.lot_id, []).append(spot)
+    for lot in lots:
+        if lot.id in stale:
+            cards[lot.id] = Markup(render_template('partials/_dashboard_lot_card.html', lot={
+                'id': lot.id,
+                'prime_location_name': lot.prime_location_name,
+                'is_active': lot.is_active,
+                'available_spots': lot.available_spots,
+                'occupied_spots': lot.occupied_count,
+                'spots': spots.get(lot.id, []),
+            }))
+            card_cache.set(lot.id, (keys[lot.id], cards[lot.id]))
+
+    return render_template('admin/dashboard.html', **kpis, lot_cards=[cards[lot.id] for lot in lots])
+
+
+@admin_bp.route('/admin_dashboard/stream')
+def admin_dashboard_stream():
+    # Server-Sent Events: live spot grid updates for the dashboard
+    return broker.stream(request.headers.get('Last-Event-ID'))
+
+
+@admin_bp.route('/sql_profiler')
+def sql_profiler_report():
+    if not session.get('admin_logged_in'):
+        abort(403)
+    return render_template('admin/sql_profiler.html',
+                           **get_admin_kpis(),
+                           enabled=sql_profiler.settings['enabled'],
+                           threshold=sql_profiler.settings['n_plus_one'],
+                           profiled=sql_profiler.worst_requests())
+
+
+@admin_bp.route('/cache_stats')
+def cache_stats():
+    # Hit/miss counters of the in-process caches of this worker
+    if not session.get('admin_logged_in'):
+        abort(403)
+    return jsonify({
+        'users': user_cache.stats(),
+        'admin_kpis': kpi_cache.stats(),
+        'dashboard_cards': card_cache.stats(),
+        'api_versions': version_cache.stats(),
+    })
     
     
     
@@ -176,9 +262,7 @@ def locations():
         # Calculate total available spots for the current location
         total_available_spots = 0
         for lot in lots:
-            # Get count of available spots in each lot
-            available_spots = ParkingSpot.query.filter_by(lot_id=lot.id, status='A').count()
-            total_available_spots += available_spots
+            total_available_spots += lot.free_count
         
         location_data.append({
             "location": loc,
@@ -186,49 +270,11 @@ def locations():
             "total_available_spots": total_available_spots  # Add the total available spots
         })
     
-    today = datetime.today().date()
-    lots = ParkingLot.query.all()
-
-    vehicles_parked_today = Reservation.query.filter(Reservation.parking_timestamp >= datetime.combine(today, datetime.min.time())).count()
-    parking_lots = []
-    
-    total_occupied_spots = 0
-    total_spots = 0
-
-    for lot in lots:
-        occupied_count = ParkingSpot.query.filter_by(lot_id=lot.id, status='O').count()
-        total = lot.available_spots or 1
-        
-        total_occupied_spots += occupied_count
-        total_spots += total
-        
-        utilization = (occupied_count / total) * 100
-        
-        parking_lots.append({
-            'id': lot.id,
-            'prime_location_name': lot.prime_location_name,
-            'available_spots': lot.available_spots,
-            'max_parking_spots': lot.max_parking_spots,
-            'occupied_spots': occupied_count,
-            'utilization_rate': round(utilization, 1)
-        })
-
-    overall_utilization = round((total_occupied_spots / total_spots) * 100, 1) if total_spots else 0
-
-    active_users = User.query.filter_by(is_active=True).count()
-    total_parking_lots = ParkingLot.query.count()
-    active_parkings = ParkingLot.query.filter_by(is_active=True).count()
-    
     selected_location_id = request.args.get('location_id', type=int)
     selected_location = Location.query.get(selected_location_id) if selected_location_id else None
 
     return render_template('admin/locations.html',
-                           active_users=active_users,
-                           parking_lots=parking_lots, 
-                           active_parkings=active_parkings, 
-                           total_parking_lots=total_parking_lots,
-                           utilization_rate=overall_utilization,
-                           vehicles_parked_today=vehicles_parked_today,
+                           **get_admin_kpis(),
                            location_data=location_data,
                            selected_location_id=selected_location_id,
                            selected_location=selected_location)
@@ -237,62 +283,66 @@ def locations():
 
 
 
-@admin_bp.route('/users', methods=['GET', 'POST'])
-def admin_users():
-    users = User.query.all()
-    user_ids = [user.id for user in users]
-    today = datetime.today().date()
-    lots = ParkingLot.query.all()
+USERS_PAGE_SIZE = 50
 
-    formatted_dates = [user.registration_date.strftime('%b %d') for user in users if user.registration_date]
-    booking_counts = [len(user.reservations) for user in users]
 
-    # Count registrations by date
-    date_counts = Counter(formatted_dates)
-    labels = list(date_counts.keys())
-    counts = list(date_counts.values())
+def users_listing(args):
+    """Template context of the users page: one page of users with their
+    booking counts, plus the chart aggregates.
 
-    vehicles_parked_today = Reservation.query.filter(Reservation.parking_timestamp >= datetime.combine(today, datetime.min.time())).count()
-    parking_lots = []
-    
-    total_occupied_spots = 0
-    total_spots = 0
-
-    for lot in lots:
-        occupied_count = ParkingSpot.query.filter_by(lot_id=lot.id, status='O').count()
-        total = lot.available_spots or 1
-        
-        total_occupied_spots += occupied_count
-        total_spots += total
-        
-        utilization = (occupied_count / total) * 100
-        
-        parking_lots.append({
-            'id': lot.id,
-            'prime_location_name': lot.prime_location_name,
-            'available_spots': lot.available_spots,
-            'occupied_spots': occupied_count,
-            'utilization_rate': round(utilization, 1)
-        })
+    Query args: q (name, email or phone), status (active/inactive),
+    flagged (yes/no), sort (id/name/registered/bookings), dir (asc/desc)
+    and page.
+    """
+    bookings = db.session.query(func.count(Reservation.id)).filter(
+        Reservation.user_id == User.id
+    ).correlate(User).scalar_subquery().label('bookings')
+    sorts = {
+        'id': [User.id],
+        'name': [User.firstname, User.lastname, User.id],
+        'registered': [User.registration_date, User.id],
+        'bookings': [bookings, User.id],
+    }
+    sort = args.get('sort') if args.get('sort') in sorts else 'id'
+    descending = args.get('dir') == 'desc'
+
+    query = db.session.query(User, bookings).options(selectinload(User.vehicles))
+    if args.get('q'):
+        term = f"%{args['q'].strip()}%"
+        query = query.filter(or_(User.firstname.ilike(term), User.lastname.ilike(term),
+                                 User.email.ilike(term), User.phone.ilike(term)))
+    if args.get('status') in ('active', 'inactive'):
+        query = query.filter(User.is_active == (args['status'] == 'active'))
+    if args.get('flagged') in ('yes', 'no'):
+        query = query.filter(User.flagged == (args['flagged'] == 'yes'))
+    query = query.order_by(*[column.desc() if descending else column for column in sorts[sort]])
+    page = query.paginate(page=args.get('page', 1, type=int), per_page=USERS_PAGE_SIZE, error_out=False)
+
+    # Chart data, aggregated in the database over every user
+    registered_on = func.date(User.registration_date)
+    registrations = db.session.query(registered_on, func.count(User.id)).filter(
+        User.registration_date.isnot(None)
+    ).group_by(registered_on).order_by(registered_on).all()
+    activity = dict(db.session.query(User.is_active, func.count(User.id)).group_by(User.is_active).all())
+
+    return {
+        'users': page.items,
+        'pagination': page,
+        'filters': args.to_dict(),
+        'sort': sort,
+        'descending': descending,
+        'labels': [datetime.strptime(day, '%Y-%m-%d').strftime('%b %d') for day, _ in registrations],
+        'counts': [count for _, count in registrations],
+        'active_count': activity.get(True, 0),
+        'inactive_count': activity.get(False, 0),
+        'user_ids': [user.id for user, _ in page.items],
+        'booking_counts': [count for _, count in page.items],
+    }
 
-    overall_utilization = round((total_occupied_spots / total_spots) * 100, 1) if total_spots else 0
 
-    active_users = User.query.filter_by(is_active=True).count()
-    total_parking_lots = ParkingLot.query.count()
-    active_parkings = ParkingLot.query.filter_by(is_active=True).count()
-
-    return render_template('admin/users.html',
-                           users=users,
-                           active_users=active_users,
-                           parking_lots=parking_lots,
-                           active_parkings=active_parkings,
-                           total_parking_lots=total_parking_lots,
-                           utilization_rate=overall_utilization,
-                           vehicles_parked_today=vehicles_parked_today,
-                           labels=labels,  
-                           counts=counts,
-                           user_ids=user_ids,
-                           booking_counts=booking_counts)  
+@admin_bp.route('/users', methods=['GET', 'POST'])
+def admin_users():
+    return render_template('admin/users.html', **get_admin_kpis(), **users_listing(request.args))
 
 
 @admin_bp.route('/users/view_user/<int:user_id>')
@@ -303,48 +353,109 @@ def user_detail(user_id):
 
 
 
-@admin_bp.route('/activity_log', methods=['GET', 'POST'])
-def activity_log():
-    users = User.query.all()
-    today = datetime.today().date()
-    lots = ParkingLot.query.all()
-    reservations = Reservation.query.order_by(Reservation.booking_timestamp.desc()).all()
-    vehicles_parked_today = Reservation.query.filter(Reservation.parking_timestamp >= datetime.combine(today, datetime.min.time())).count()
-    parking_lots = []
-    
-    total_occupied_spots = 0
-    total_spots = 0
+ACTIVITY_PAGE_SIZE = 50
+RESERVATION_STATUSES = ['Pending', 'Confirmed', 'Parked', 'Parked Out', 'Cancelled', 'Rejected']
 
-    for lot in lots:
-        occupied_count = ParkingSpot.query.filter_by(lot_id=lot.id, status='O').count()
-        total = lot.available_spots or 1
-        
-        total_occupied_spots += occupied_count
-        total_spots += total
-        
-        utilization = (occupied_count / total) * 100
-        
-        parking_lots.append({
-            'id': lot.id,
-            'prime_location_name': lot.prime_location_name,
-            'available_spots': lot.available_spots,
-            'occupied_spots': occupied_count,
-            'utilization_rate': round(utilization, 1)
-        })
 
-    overall_utilization = round((total_occupied_spots / total_spots) * 100, 1) if total_spots else 0
+def activity_filters(args):
+    """Reservation filters from the lot_id, status, date_from and date_to query args."""
+    filters = []
+    if args.get('lot_id', type=int):
+        filters.append(Reservation.lot_id == args.get('lot_id', type=int))
+    if args.get('status') in RESERVATION_STATUSES:
+        filters.append(Reservation.status == args['status'])
+    try:
+        if args.get('date_from'):
+            filters.append(Reservation.booking_timestamp >= datetime.strptime(args['date_from'], '%Y-%m-%d'))
+        if args.get('date_to'):
+            filters.append(Reservation.booking_timestamp < datetime.strptime(args['date_to'], '%Y-%m-%d') + timedelta(days=1))
+    except ValueError:
+        abort(400)
+    return filters
+
+
+def activity_page(filters, cursor=None, page_size=ACTIVITY_PAGE_SIZE):
+    """One page of reservations, newest booking first, and the cursor of the next page.
+
+    Pages are keyed on (booking_timestamp, id) rather than offsets, so a
+    page deep in the log costs the same as the first one. The cursor is
+    '<booking timestamp>_<id>' of the last row shown.
+    """
+    query = Reservation.query.options(
+        joinedload(Reservation.user),
+        joinedload(Reservation.vehicle),
+        joinedload(Reservation.spot).joinedload(ParkingSpot.lot),
+    ).filter(*filters)
+    if cursor:
+        try:
+            booked_at, res_id = cursor.rsplit('_', 1)
+            booked_at, res_id = datetime.fromisoformat(booked_at), int(res_id)
+        except ValueError:
+            abort(400)
+        # Written so the booking_timestamp index can seek straight to the cursor
+        query = query.filter(
+            Reservation.booking_timestamp <= booked_at,
+            or_(Reservation.booking_timestamp < booked_at, Reservation.id < res_id)
+        )
+    rows = query.order_by(Reservation.booking_timestamp.desc(), Reservation.id.desc()).limit(page_size + 1).all()
 
-    active_users = User.query.filter_by(is_active=True).count()
-    total_parking_lots = ParkingLot.query.count()
-    active_parkings = ParkingLot.query.filter_by(is_active=True).count()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = f'{rows[-1].booking_timestamp.isoformat()}_{rows[-1].id}'
+    return rows, next_cursor
+
+
+@admin_bp.route('/activity_log', methods=['GET', 'POST'])
+def activity_log():
+    filters = activity_filters(request.args)
+    reservations, next_cursor = activity_page(filters)
+    total = db.session.query(func.count(Reservation.id)).filter(*filters).scalar()
+    lots = db.session.query(ParkingLot.id, ParkingLot.prime_location_name).order_by(ParkingLot.prime_location_name).all()
     return render_template('admin/activity_log.html',
-                           active_users=active_users,
-                           parking_lots=parking_lots, 
-                           active_parkings=active_parkings, 
-                           total_parking_lots=total_parking_lots,
-                           utilization_rate=overall_utilization,
-                           vehicles_parked_today=vehicles_parked_today,
-                           reservations=reservations)
+                           **get_admin_kpis(),
+                           reservations=reservations,
+                           total=total,
+                           next_cursor=next_cursor,
+                           lots=lots,
+                           statuses=RESERVATION_STATUSES,
+                           filters=request.args)
+
+
+@admin_bp.route('/activity_log/page')
+def activity_log_page():
+    # Infinite scroll: the rows after ``cursor`` with the same filters
+    reservations, next_cursor = activity_page(activity_filters(request.args), request.args.get('cursor'))
+    return jsonify({
+        'html': render_template('partials/_activity_log_rows.html', reservations=reservations),
+        'count': len(reservations),
+        'next_cursor': next_cursor,
+    })
+
+
+@admin_bp.route('/export/reservations.<fmt>')
+def export_reservations_file(fmt):
+    # Streams every matching reservation; the lot/status/date filters match the activity log's
+    if not session.get('admin_logged_in'):
+        abort(403)
+    if fmt not in FORMATS:
+        abort(404)
+    try:
+        date_from, date_to = [datetime.strptime(request.args[arg], '%Y-%m-%d').date() if request.args.get(arg) else None
+                              for arg in ('date_from', 'date_to')]
+    except ValueError:
+        abort(400)
+    filters = reservation_filters(
+        lot_id=request.args.get('lot_id', type=int),
+        status=request.args.get('status') if request.args.get('status') in RESERVATION_STATUSES else None,
+        date_from=date_from,
+        date_to=date_to,
+    )
+    filename = f"reservations-{datetime.now():%Y%m%d-%H%M%S}.{fmt}"
+    return Response(stream_with_context(export_reservations(fmt, filters)), mimetype=FORMATS[fmt], headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'X-Accel-Buffering': 'no',
+    })
 
 
 @admin_bp.route('/reservations/booking_details/<string:booking_id>', methods=['GET', 'POST'])
@@ -361,127 +472,89 @@ def booking_details(booking_id):
 
 
 
-@admin_bp.route('/statistics', methods=['GET', 'POST'])
-def statistics():
-    
-    users = User.query.all()
-    today = datetime.today().date()
-    lots = ParkingLot.query.all()
+def live_chart_counts(today):
+    """Same counts as rollups.admin_chart_counts, computed from the reservations."""
+    hourly_counts = [0] * 24
+    hour = extract('hour', Reservation.expected_arrival)
+    for res_hour, count in db.session.query(hour, func.count(Reservation.id)).filter(
+        Reservation.expected_arrival.isnot(None)
+    ).group_by(hour):
+        hourly_counts[int(res_hour)] = count
 
-    vehicles_parked_today = Reservation.query.filter(Reservation.parking_timestamp >= datetime.combine(today, datetime.min.time())).count()
-    parking_lots = []
-    
-    total_occupied_spots = 0
-    total_spots = 0
+    first_day = today - timedelta(days=6)
+    arrival_day = func.date(Reservation.expected_arrival)
+    daily_counts = dict(db.session.query(arrival_day, func.count(Reservation.id)).filter(
+        Reservation.expected_arrival >= datetime.combine(first_day, datetime.min.time()),
+        Reservation.expected_arrival < datetime.combine(today + timedelta(days=1), datetime.min.time())
+    ).group_by(arrival_day).all())
 
-    for lot in lots:
-        occupied_count = ParkingSpot.query.filter_by(lot_id=lot.id, status='O').count()
-        total = lot.available_spots or 1
-        
-        total_occupied_spots += occupied_count
-        total_spots += total
-        
-        utilization = (occupied_count / total) * 100
-        
-        parking_lots.append({
-            'id': lot.id,
-            'prime_location_name': lot.prime_location_name,
-            'available_spots': lot.available_spots,
-            'occupied_spots': occupied_count,
-            'utilization_rate': round(utilization, 1)
-        })
+    duration_hours = func.round(
+        (func.julianday(Reservation.leaving_timestamp) - func.julianday(Reservation.parking_timestamp)) * 24, 2
+    )
+    bracket = case(
+        (duration_hours < 1, 0),
+        (duration_hours < 2, 1),
+        (duration_hours < 4, 2),
+        (duration_hours < 8, 3),
+        else_=4
+    )
+    duration_brackets = [0] * 5  # [<1h, 1-2h, 2-4h, 4-8h, 8+h]
+    for index, count in db.session.query(bracket, func.count(Reservation.id)).filter(
+        Reservation.expected_arrival >= datetime.combine(today - timedelta(days=7), datetime.min.time()),
+        Reservation.leaving_timestamp.isnot(None),
+        Reservation.parking_timestamp.isnot(None)
+    ).group_by(bracket):
+        duration_brackets[index] = count
 
-    hourly_occupancy = [0] * 24
-    all_reservations = Reservation.query.all()  # Get ALL reservations, not just today's
+    status_counts = dict(db.session.query(Reservation.status, func.count(Reservation.id))
+                         .group_by(Reservation.status).all())
+
+    status_data = {
+        'pending': status_counts.get('Pending', 0),
+        'parked': status_counts.get('Parked', 0),
+        'confirmed': status_counts.get('Confirmed', 0),
+        'parked_out': status_counts.get('Parked Out', 0),
+        'cancelled_rejected': status_counts.get('Cancelled', 0) + status_counts.get('Rejected', 0)
+    }
+
+    return hourly_counts, daily_counts, duration_brackets, status_data
+
+
+@admin_bp.route('/statistics', methods=['GET', 'POST'])
+def statistics():
+    kpis = get_admin_kpis()
+    today = datetime.today().date()
 
-    for res in all_reservations:
-        if res.expected_arrival:  # Ensure the field exists
-            hour = res.expected_arrival.hour
-            hourly_occupancy[hour] += 1
+    if rollups_are_fresh(current_app.config['ROLLUP_MAX_AGE']):
+        hourly_counts, daily_counts, duration_brackets, status_data = admin_chart_counts(today)
+    else:
+        hourly_counts, daily_counts, duration_brackets, status_data = live_chart_counts(today)
 
-    total_reservations = max(1, sum(hourly_occupancy))  # Avoid division by zero
-    hourly_occupancy = [round((count / total_reservations * 100),2) for count in hourly_occupancy]
+    # Share of all reservations by hour of expected arrival
+    total_reservations = max(1, sum(hourly_counts))  # Avoid division by zero
+    hourly_occupancy = [round((count / total_reservations * 100),2) for count in hourly_counts]
     
     usage_trend = []
     date_labels = []
 
     for i in range(6, -1, -1):  # Last 7 days
         day = today - timedelta(days=i)
-        count = Reservation.query.filter(
-            Reservation.expected_arrival >= datetime.combine(day, datetime.min.time()),
-            Reservation.expected_arrival <= datetime.combine(day, datetime.max.time())
-        ).count()
-        
-        usage_trend.append(count)
+        usage_trend.append(daily_counts.get(day.isoformat(), 0))
         date_labels.append(day.strftime('%b %d'))
         
 
-    overall_utilization = round((total_occupied_spots / total_spots) * 100, 1) if total_spots else 0
-
-    active_users = User.query.filter_by(is_active=True).count()
-    total_parking_lots = ParkingLot.query.count()
-    active_parkings = ParkingLot.query.filter_by(is_active=True).count()
-    available_spots = total_spots - total_occupied_spots
-
-    duration_brackets = [0] * 5  # [<1h, 1-2h, 2-4h, 4-8h, 8+h]
-    completed_reservations = Reservation.query.filter(
-        Reservation.expected_arrival >= datetime.combine(today - timedelta(days=7), datetime.min.time()),
-        Reservation.leaving_timestamp.isnot(None)
-    ).all()
-
-    # Count raw values first
-    for res in completed_reservations:
-        duration_hours = round(((res.leaving_timestamp - res.parking_timestamp).total_seconds() / 3600), 2)
-        
-        if duration_hours < 1:
-            duration_brackets[0] += 1
-        elif 1 <= duration_hours < 2:
-            duration_brackets[1] += 1
-        elif 2 <= duration_hours < 4:
-            duration_brackets[2] += 1
-        elif 4 <= duration_hours < 8:
-            duration_brackets[3] += 1
-        else:
-            duration_brackets[4] += 1
+    available_spots = kpis['total_spots'] - kpis['occupied_spots']
 
     # Convert to percentages
     total_reservations = max(1, sum(duration_brackets))  # Avoid division by zero
     duration_percentages = [round((count / total_reservations * 100), 1) for count in duration_brackets]
 
-    pending_count = Reservation.query.filter_by(status='Pending').count()
-    parked_count = Reservation.query.filter_by(status='Parked').count()
-    confirmed_count = Reservation.query.filter_by(status='Confirmed').count()
-    parked_out_count = Reservation.query.filter_by(status='Parked Out').count()
-    combined_count = Reservation.query.filter(
-        or_(
-            Reservation.status == 'Cancelled',
-            Reservation.status == 'Rejected'
-        )
-    ).count()
-
-    status_data = {
-        'pending': pending_count,
-        'parked': parked_count,
-        'confirmed': confirmed_count,
-        'parked_out': parked_out_count,
-        'cancelled_rejected': combined_count
-        
-    }
-
 
 
     return render_template('admin/statistics.html',
-                           active_users=active_users,
-                           parking_lots=parking_lots, 
-                           active_parkings=active_parkings, 
-                           total_parking_lots=total_parking_lots,
-                           utilization_rate=overall_utilization,
-                           vehicles_parked_today=vehicles_parked_today,
+                           **kpis,
                            status_data=status_data,
                            parking_durations=duration_percentages,
-                           
-
-                           occupied_spots=total_occupied_spots,
                            available_spots=available_spots,
                            hourly_occupancy=hourly_occupancy,
                            usage_trend=usage_trend,
@@ -540,11 +613,7 @@ def add_parking_lot():
 
     # Change parking lot upload to:
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        upload_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'parking_lots')
-        os.makedirs(upload_dir, exist_ok=True)  # Ensure directory exists
-        file.save(os.path.join(upload_dir, filename))  # Save to subfolder
-        image_url = f'uploads/parking_lots/{filename}'  
+        image_url = f"uploads/{save_upload(file, 'parking_lots')}"
 
     try:
         prime_location_name = request.form.get('prime_location_name', '')
@@ -579,8 +648,7 @@ def add_parking_lot():
         db.session.commit()
 
         # Create parking spots
-        for i in range(available_spots):
-            db.session.add(ParkingSpot(lot_id=new_parking_lot.id, spot_number=i + 1))
+        new_parking_lot.add_spots(available_spots)
         db.session.commit()
 
         flash('Parking lot added successfully.')
@@ -623,17 +691,14 @@ def view_spot(lot_id, spot_number):
 def delete_spot(spot_id):
     spot = ParkingSpot.query.get_or_404(spot_id)
 
-    # Ensure the spot is not occupied
-    if spot.status == 'O':
+    # Mark the spot as unavailable (soft delete), unless it is occupied
+    if not spot.set_status('X', expected=('A', 'B')):
         flash("Cannot delete an occupied spot.", "warning")
         return redirect(request.referrer)
 
     # Get the corresponding parking lot
     parking_lot = ParkingLot.query.get(spot.lot_id)
 
-    # Mark the spot as unavailable (soft delete)
-    spot.status = 'X'
-
     # Decrement the number of available spots
     if parking_lot.available_spots > 0:
         parking_lot.available_spots -= 1
@@ -651,8 +716,11 @@ def restore_spot(spot_id):
         flash("Spot is already active or occupied.", "info")
         return redirect(request.referrer)
 
-    # Restore the spot
-    spot.status = 'A'
+    # Restore the spot and hand it to the waitlist if anyone is due now
+    if not spot.set_status('A', expected=('X',)):
+        flash("Spot is already active or occupied.", "info")
+        return redirect(request.referrer)
+    assign_pending_reservation(spot)
 
     # Increment available spots in the corresponding lot
     parking_lot = ParkingLot.query.get(spot.lot_id)
@@ -670,24 +738,15 @@ def restore_spot(spot_id):
 @admin_bp.route('/admin/edit_parking/<int:lot_id>', methods=['GET', 'POST'])
 def edit_parking(lot_id):
     parking_lot = ParkingLot.query.get_or_404(lot_id)
+    old_image = None
     
     # Handle file upload only if new file was provided
     if 'image' in request.files:
         file = request.files['image']
         if file.filename != '' and allowed_file(file.filename):
-            # Delete old image if exists
-            if parking_lot.image_url:
-                old_path = os.path.join(current_app.config['UPLOAD_FOLDER'], parking_lot.image_url)
-                if os.path.exists(old_path):
-                    os.remove(old_path)
-            
-            # Save new image
-            filename = secure_filename(file.filename)
-            unique_name = f"lot_{lot_id}_{filename}"
-            upload_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'parking_lots', unique_name)
-            os.makedirs(os.path.dirname(upload_path), exist_ok=True)
-            file.save(upload_path)
-            parking_lot.image_url = f"uploads/parking_lots/{unique_name}"
+            # The old image is deleted once the new one is committed
+            old_image = parking_lot.image_url
+            parking_lot.image_url = f"uploads/{save_upload(file, 'parking_lots')}"
     
     
 
@@ -747,30 +806,26 @@ def edit_parking(lot_id):
                 suggested_to=suggested_to
             )
 
-        existing_spots = ParkingSpot.query.filter_by(lot_id=lot_id).order_by(ParkingSpot.spot_number).all()
-        existing_count = len(existing_spots)
+        existing_count = ParkingSpot.query.filter_by(lot_id=lot_id).count()
         new_count = int(request.form['available_spots'])
 
+        new_spots = []
         if new_count > existing_count:
-            # Add new spots
-            for i in range(existing_count + 1, new_count + 1):
-                new_spot = ParkingSpot(
-                    lot_id=lot_id,
-                    spot_number=i,
-                    status='A'  
-                )
-                db.session.add(new_spot)
+            first_new = parking_lot.add_spots(new_count - existing_count)
+            # Only as many of the new spots as there are requests that could use one
+            waiting = Reservation.query.filter_by(lot_id=lot_id, status='Pending', spot_id=None).count()
+            new_spots = ParkingSpot.query.filter(
+                ParkingSpot.lot_id == lot_id, ParkingSpot.spot_number >= first_new
+            ).order_by(ParkingSpot.spot_number).limit(waiting).all()
         elif new_count < existing_count:
             # Remove only unoccupied/unbooked/unreserved spots from the end
-            removable = [s for s in reversed(existing_spots) if s.status not in ['O', 'B', 'X']]
-            to_remove = removable[:existing_count - new_count]
-            
-            if len(to_remove) < (existing_count - new_count):
+            if not parking_lot.remove_spots(existing_count - new_count):
+                db.session.rollback()
                 flash("⚠️ Cannot remove that many spots because some are in use or booked.", "warning")
                 return redirect(url_for('admin.edit_parking', lot_id=lot_id))
 
-            for spot in to_remove:
-                db.session.delete(spot)
+        parking_lot.recount_spots()
+        promote_pending_reservations(lot_id, new_spots)
 
         # Proceed with update
         parking_lot.prime_location_name = request.form['prime_location_name']
@@ -781,6 +836,11 @@ def edit_parking(lot_id):
         parking_lot.is_active = new_active_state
 
         db.session.commit()
+
+        # Delete the replaced image unless another lot shares it (uploads are shared by identical content)
+        if old_image and old_image != parking_lot.image_url and not ParkingLot.query.filter_by(image_url=old_image).first():
+            remove_upload(os.path.join(current_app.static_folder, old_image))
+
         flash("Parking lot updated successfully.", "success")
         return redirect(url_for('admin.admin_dashboard'))
 
@@ -794,14 +854,17 @@ def delete_parking(lot_id):
     parking_lot = ParkingLot.query.get_or_404(lot_id)
 
     # Check if all parking spots are available
-    has_occupied_spots = any(spot.status != 'A' for spot in parking_lot.spots)
+    has_occupied_spots = ParkingSpot.query.filter(ParkingSpot.lot_id == lot_id, ParkingSpot.status != 'A').first()
 
-    if has_occupied_spots:
+    # Spots go in one DELETE, which also backs off if a booking just took one
+    if has_occupied_spots or not parking_lot.remove_spots(ParkingSpot.query.filter_by(lot_id=lot_id).count()):
+        db.session.rollback()
         flash('Cannot delete parking lot. Some spots are still occupied or booked.', 'error')
         return redirect(url_for('admin.admin_dashboard'))  
 
     # If all spots are empty, proceed with deletion
     db.session.delete(parking_lot)
+    mark_lots_changed(lot_id)
     db.session.commit()
 
     flash('Parking lot deleted successfully.', 'success')
@@ -824,6 +887,7 @@ def flag_user_confirmation(id):
             is_flagged=True
         )
         db.session.add(flag)
+        user.refresh_flag_state()
         db.session.commit()
         
         user.is_active = False
@@ -849,6 +913,7 @@ def unflag_user(id):
 
     if flag:
         db.session.delete(flag)  # Delete the flag
+        user.refresh_flag_state()
         db.session.commit()
 
     user.is_active = True  # Set the user back to active
@@ -859,26 +924,7 @@ def unflag_user(id):
 
 @admin_bp.route('/admin/user_stats')
 def user_stats():
-    users = User.query.all()
-
-    # User registration stats
-    formatted_dates = [user.registration_date.strftime('%b %d') for user in users]
-    date_counts = Counter(formatted_dates)
-    labels = list(date_counts.keys())
-    counts = list(date_counts.values())
-
-    # Bookings per user
-    user_ids = [user.id for user in users]
-    booking_counts = [len(user.reservations) for user in users]  # Assuming User has a backref 'reservations'
-
-    return render_template(
-        'admin/users.html',
-        users=users,
-        labels=labels,
-        counts=counts,
-        user_ids=user_ids,
-        booking_counts=booking_counts
-    )
+    return render_template('admin/users.html', **users_listing(request.args))
 
 @admin_bp.route('/admin/users/delete/<int:id>', methods=['POST'])
 def delete_user(id):
@@ -0,0 +1,131 @@
+from flask import Blueprint, jsonify, request, current_app, abort
+import hashlib
+
+from model import *
+from cache import TTLCache
+
+api_bp = Blueprint('api', __name__)
+
+# lot id -> (location id, occupancy version), shared by every ETag check
+version_cache = TTLCache(maxsize=1)
+
+
+def lot_versions():
+    """Current occupancy version of every lot, read at most once per API_VERSION_TTL."""
+    return version_cache.get_or_set('lots', lambda: {
+        lot_id: (location_id, version) for lot_id, location_id, version in db.session.query(
+            ParkingLot.id, ParkingLot.location_id, ParkingLot.occupancy_version
+        )
+    }, ttl=current_app.config['API_VERSION_TTL'])
+
+
+@on_lots_changed
+def _forget_lot_versions(lot_ids):
+    version_cache.clear()
+
+
+def _etag(kind, versions):
+    # Strong validator over the (lot id, version) pairs a response is built from
+    digest = hashlib.sha1(repr(sorted(versions)).encode()).hexdigest()[:20]
+    return f'{kind}-{digest}'
+
+
+def _conditional(kind, versions, build):
+    """304 straight from the cached ``versions``, otherwise build the body.
+
+    ``build`` returns (payload, versions); the ETag sent with a fresh body
+    comes from the versions it was actually built from.
+    """
+    etag = _etag(kind, versions) if versions else None
+    if etag is not None and request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        payload, versions = build()
+        response = jsonify(payload)
+        etag = _etag(kind, versions)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'  # always revalidate, it's cheap
+    return response
+
+
+def _lot_json(lot):
+    return {
+        'id': lot.id,
+        'name': lot.prime_location_name,
+        'location_id': lot.location_id,
+        'is_active': lot.is_active,
+        'price_per_hour': lot.price_per_hour,
+        'available_from': lot.available_from.strftime('%H:%M') if lot.available_from else None,
+        'available_to': lot.available_to.strftime('%H:%M') if lot.available_to else None,
+        'max_parking_spots': lot.max_parking_spots,
+        'available_spots': lot.available_spots,
+        'free': lot.free_count,
+        'booked': lot.booked_count,
+        'occupied': lot.occupied_count,
+        'currently_available': lot.free_count + lot.booked_count,
+        'version': lot.occupancy_version,
+    }
+
+
+def _location_json(location, lots):
+    lots = [_lot_json(lot) for lot in lots]
+    return {
+        'id': location.id,
+        'name': location.name,
+        'address': location.address,
+        'pin_code': location.pin_code,
+        'max_parking_spots': sum(lot['max_parking_spots'] for lot in lots),
+        'available_spots': sum(lot['available_spots'] for lot in lots),
+        'currently_available': sum(lot['currently_available'] for lot in lots),
+        'lots': lots,
+    }
+
+
+def _locations_payload(location_id=None):
+    query = ParkingLot.query.order_by(ParkingLot.location_id, ParkingLot.id)
+    if location_id is not None:
+        query = query.filter(ParkingLot.location_id == location_id)
+    lots_by_location = {}
+    for lot in query:
+        lots_by_location.setdefault(lot.location_id, []).append(lot)
+
+    locations = Location.query.filter(Location.id.in_(lots_by_location)).order_by(Location.id).all()
+    payload = [_location_json(location, lots_by_location[location.id]) for location in locations]
+    versions = [(lot.id, lot.occupancy_version) for lots in lots_by_location.values() for lot in lots]
+    return payload, versions
+
+
+@api_bp.route('/availability')
+def availability():
+    versions = [(lot_id, version) for lot_id, (_, version) in lot_versions().items()]
+
+    def build():
+        payload, built_versions = _locations_payload()
+        return {'locations': payload}, built_versions
+
+    return _conditional('all', versions, build)
+
+
+@api_bp.route('/locations/<int:location_id>/availability')
+def location_availability(location_id):
+    versions = [(lot_id, version) for lot_id, (lot_location, version) in lot_versions().items()
+                if lot_location == location_id]
+
+    def build():
+        payload, built_versions = _locations_payload(location_id)
+        if not payload:
+            abort(404)
+        return payload[0], built_versions
+
+    return _conditional('location', versions, build)
+
+
+@api_bp.route('/lots/<int:lot_id>/availability')
+def lot_availability(lot_id):
+    known = lot_versions().get(lot_id)
+
+    def build():
+        lot = db.session.get(ParkingLot, lot_id) or abort(404)
+        return _lot_json(lot), [(lot.id, lot.occupancy_version)]
+
+    return _conditional('lot', [(lot_id, known[1])] if known else None, build)
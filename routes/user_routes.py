@@ -2,8 +2,8 @@ from flask import Blueprint, render_template, redirect, url_for, flash, request,
 from model import *
 import os
 from flask import current_app
-from werkzeug.utils import secure_filename
 import uuid
+import time
 from sqlalchemy.orm import joinedload
 from sqlalchemy import func
 from functools import wraps
@@ -13,6 +13,11 @@ from datetime import datetime, timedelta
 from sqlalchemy import or_, and_
 from pytz import utc
 from utils import *
+from spot_index import claim_free_spot
+from rollups import rollups_are_fresh, user_chart_rows
+from live import broker
+from images import save_upload, remove_upload
+from metrics import spot_allocation
 
 
 user_bp = Blueprint('user', __name__)
@@ -164,8 +169,7 @@ def park(booking_id):
         # More than 30 mins late — mark as No Show
         booking.status = 'Rejected'
         if booking.spot:
-            booking.spot.status = 'A'
-            assign_pending_reservation(booking.spot)
+            release_spot(booking.spot)
         booking.cancellation_reason = 'Showed up too late.'
         db.session.commit()
         flash('You have missed your parking time. Booking rejected.', 'warning')
@@ -176,13 +180,17 @@ def park(booking_id):
         flash('Your vehicle is not expected for parking yet. Please come closer to your expected arrival time.', 'warning')
         return redirect(url_for('user.dashboard'))
 
-    # Check if assigned spot is still free
-    if booking.spot.status == 'O':
-        # Spot occupied — find next available in same lot
-        available_spot = ParkingSpot.query.filter_by(
+    # Claim the assigned spot unless someone else is parked in it
+    if not booking.spot.set_status('O', expected=('A', 'B')):
+        # Spot occupied — claim the next available one in the same lot
+        available_spot = None
+        for candidate in ParkingSpot.query.filter_by(
             lot_id=booking.spot.lot_id,
             status='A'
-        ).first()
+        ).limit(ParkingSpot.CLAIM_ATTEMPTS):
+            if candidate.set_status('O', expected=('A',)):
+                available_spot = candidate
+                break
 
         if not available_spot:
             flash('No spot currently available in your lot. Please wait or contact support.', 'danger')
@@ -192,7 +200,6 @@ def park(booking_id):
         booking.spot = available_spot
 
     # Proceed to park
-    booking.spot.status = 'O'
     booking.parking_timestamp = current_time
     booking.status = 'Parked'
     db.session.commit()
@@ -224,8 +231,8 @@ def park_out(reservation_id):
         reservation.parking_cost = hours_parked * reservation.spot.lot.price_per_hour
         reservation.status = 'Parked Out'
 
-        reservation.spot.status = 'A'
-        assign_pending_reservation(reservation.spot)
+        # Later bookings of the spot keep it booked; only a spot nobody holds is freed
+        release_spot(reservation.spot, expected=None)
 
         db.session.commit()
 
@@ -277,16 +284,7 @@ def add_vehicle():
             if not allowed_file(vehicle_image_file.filename):
                 errors.append('Invalid file type. Only JPG, JPEG, PNG allowed.')
             else:
-                filename = secure_filename(vehicle_image_file.filename)
-                unique_filename = f"{uuid.uuid4().hex}_{filename}"
-                
-                # Explicit path construction
-                upload_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'vehicles')
-                os.makedirs(upload_dir, exist_ok=True)
-                upload_path = os.path.join(upload_dir, unique_filename)
-                
-                vehicle_image_file.save(upload_path)
-                vehicle_image_path = f"vehicles/{unique_filename}"  # Store relative path
+                vehicle_image_path = save_upload(vehicle_image_file, 'vehicles')  # Store relative path
                 
         
         if errors:
@@ -315,10 +313,9 @@ def add_vehicle():
                 db.session.rollback()
                 flash(f'Error adding vehicle: {str(e)}', 'error')
                 
-                # Clean up the uploaded file if there was an error
-                full_path = os.path.join(current_app.config['UPLOAD_FOLDER'], vehicle_image_path)
-                if vehicle_image_path and os.path.exists(full_path):
-                    os.remove(full_path)
+                # Clean up the uploaded file if there was an error (and no one else shares it)
+                if vehicle_image_path and not Vehicle.query.filter_by(vehicle_image=vehicle_image_path).first():
+                    remove_upload(os.path.join(current_app.config['UPLOAD_FOLDER'], vehicle_image_path))
 
     
     return render_template('partials/_add_new_vehicle.html',
@@ -353,10 +350,7 @@ def search():
         
         # Calculate available spots for each parking lot
         for lot in parking_lots:
-            lot.available_count = ParkingSpot.query.filter_by(
-                lot_id=lot.id,
-                status='A'
-            ).count()
+            lot.available_count = lot.free_count
     
     return render_template('user/search.html',
                          query=query,
@@ -372,7 +366,7 @@ def locations():
     now = datetime.now()  
 
     locations = Location.query.options(
-        joinedload(Location.parking_lots).joinedload(ParkingLot.spots)
+        joinedload(Location.parking_lots)
     ).filter(Location.parking_lots.any(ParkingLot.is_active == True)).all()
     
     location_data = []
@@ -389,29 +383,13 @@ def locations():
         total_spots = sum(lot.max_parking_spots for lot in active_lots)
         available_spots = sum(lot.available_spots for lot in active_lots)  
         
-        lot_ids = [lot.id for location in locations for lot in location.parking_lots]
-        
-        # Calculate currently available spots (not reserved)
+        # Currently available = spots nobody is parked in (A or B), straight
+        # from the counters ParkingSpot.set_status keeps on each lot
         currently_available = 0
         location_lots = []
         
         for lot in active_lots:
-            lot_currently_available = 0
-            for spot in lot.spots:
-                if spot.status == 'A' or spot.status == 'B':  # Currently Not Occupied
-                    # Check for any conflicting reservations (both parked and upcoming)
-                    conflict = Reservation.query.filter(
-                        Reservation.spot_id == spot.id,
-                        Reservation.status == 'Confirmed',
-                        Reservation.expected_arrival >= now,
-                        Reservation.expected_departure >= now
-                    ).first()
-                    
-                    lot_currently_available += 1
-                    
-                    if not conflict:
-                        pass
-            
+            lot_currently_available = lot.free_count + lot.booked_count
             currently_available += lot_currently_available
             
             # Prepare lot data for template
@@ -428,6 +406,7 @@ def locations():
             })
         
         location_data.append({
+            'id': location.id,
             'name': location.name,
             'address': location.address,
             'pin_code': location.pin_code,
@@ -448,6 +427,12 @@ def locations():
                          now=now)
 
 
+@user_bp.route('/parking_locations/stream')
+def locations_stream():
+    # Server-Sent Events: per-lot availability changes for the locations page
+    return broker.stream(request.headers.get('Last-Event-ID'), channel='counts')
+
+
 
 @user_bp.route('/parking/<int:lot_id>')
 def view_parking_details(lot_id):
@@ -494,9 +479,7 @@ def view_parking_details(lot_id):
 @user_bp.route('/book/<int:lot_id>', methods=['GET', 'POST'])
 @login_required
 def book_parking(lot_id):
-    parking_lot = ParkingLot.query.options(
-        joinedload(ParkingLot.spots)
-    ).get_or_404(lot_id)
+    parking_lot = ParkingLot.query.get_or_404(lot_id)
     
     if not parking_lot.is_active:
         flash('This parking lot is currently unavailable', 'error')
@@ -520,8 +503,11 @@ def book_parking(lot_id):
         return redirect(url_for('user.add_vehicle'))
 
 
-    all_spots = parking_lot.spots
-    available_spots = [spot for spot in all_spots if spot.status == 'A']
+    spot_counts = dict(db.session.query(
+        ParkingSpot.status,
+        func.count(ParkingSpot.id)
+    ).filter(ParkingSpot.lot_id == lot_id).group_by(ParkingSpot.status).all())
+    has_spots = bool(spot_counts)
         
     if request.method == 'POST':
         vehicle_id = request.form.get('vehicle_id')
@@ -565,45 +551,15 @@ def book_parking(lot_id):
         expected_arrival_dt = datetime.combine(today, expected_arrival_time)
         expected_departure_dt = datetime.combine(today, expected_departure_time)
 
-        available_spot = None
         status = "Pending"  
         
-        # Find first available spot without time conflicts
-        # for spot in available_spots:
-        for spot in all_spots:
-            conflict = False
-            for reservation in spot.reservations:
-                if reservation.status not in ['Cancelled', 'Parked Out']:
-                    if not (expected_departure_dt <= reservation.expected_arrival or 
-                           expected_arrival_dt >= reservation.expected_departure):
-                        conflict = True
-                        break
-                    
-            if not conflict:
-                available_spot = spot
-                status = "Confirmed"
-                break
-
-        if not available_spot:
-            occupied_spots = [spot for spot in all_spots if spot.status == 'O']
-            for spot in occupied_spots:
-                will_be_free = True
-                for reservation in spot.reservations:
-                    if reservation.status not in ['Cancelled', 'Parked Out']:
-                        # Compare with the reservation's EXPECTED times
-                        if not (expected_departure_dt <= reservation.expected_arrival or 
-                            expected_arrival_dt >= reservation.expected_departure):
-                            will_be_free = False
-                            break
-                if will_be_free:
-                    available_spot = spot
-                    break
-                
-            if not available_spot:
-                # No spots available at all - assign to first spot anyway as pending
-                available_spot = all_spots[0] if all_spots else None
-        
-        if not available_spot:
+        # Atomically claim the first spot whose booked intervals leave [arrival, departure) free
+        started = time.perf_counter()
+        available_spot = claim_free_spot(lot_id, expected_arrival_dt, expected_departure_dt)
+        spot_allocation.observe(time.perf_counter() - started, 'allocated' if available_spot else 'waitlisted')
+        if available_spot is not None:
+            status = "Confirmed"
+        elif not has_spots:
             flash('This parking lot has no spots configured', 'error')
             return redirect(url_for('user.locations'))
 
@@ -615,7 +571,7 @@ def book_parking(lot_id):
             booking_id = f"BK-{vehicle_number}-{current_user.id}-{uuid.uuid4().hex[:3].upper()}"
             
             reservation = Reservation(
-                spot_id=available_spot.id if status == "Confirmed" else None,
+                spot_id=available_spot.id if available_spot else None,
                 user_id=current_user.id,
                 vehicle_id=vehicle.id,
                 booking_timestamp=datetime.now(),
@@ -628,7 +584,6 @@ def book_parking(lot_id):
             )
             
             if status == "Confirmed":
-                available_spot.status = 'B'
                 db.session.add(reservation)
                 db.session.commit()
                 # flash(f'Booking confirmed! Expected cost: ₹{cost:.2f}', 'success')
@@ -651,7 +606,7 @@ def book_parking(lot_id):
     return render_template('partials/_book_parking.html',
                          parking_lot=parking_lot,
                          vehicles=vehicles,
-                         available_spots_count=len(available_spots))
+                         available_spots_count=spot_counts.get('A', 0))
 
 
 @user_bp.route('/favorites/<int:lot_id>', methods=['POST'])
@@ -775,8 +730,7 @@ def cancel_booking(booking_id):
         if reservation.status in ['Confirmed', 'Pending']:
             reservation.status = 'Cancelled'
             if reservation.spot:
-                reservation.spot.status = 'A'
-                assign_pending_reservation(reservation.spot)
+                release_spot(reservation.spot)
             reservation.cancellation_reason = "Cancelled by user."
             db.session.commit()
             flash('Your booking has been cancelled.', 'success')
@@ -844,15 +798,13 @@ def add_review(reservation_id):
 
 
 
-@user_bp.route('/stats', methods=['GET'])
-@login_required
-def statistics():
+def live_user_chart_rows(user_id):
     # Status counts (unchanged)
-    pending_count = Reservation.query.filter_by(user_id=current_user.id, status='Pending').count()
-    confirmed_count = Reservation.query.filter_by(user_id=current_user.id, status='Confirmed').count()
-    parked_out_count = Reservation.query.filter_by(user_id=current_user.id, status='Parked Out').count()
+    pending_count = Reservation.query.filter_by(user_id=user_id, status='Pending').count()
+    confirmed_count = Reservation.query.filter_by(user_id=user_id, status='Confirmed').count()
+    parked_out_count = Reservation.query.filter_by(user_id=user_id, status='Parked Out').count()
     combined_count = Reservation.query.filter(
-        Reservation.user_id == current_user.id,
+        Reservation.user_id == user_id,
         or_(
             Reservation.status == 'Cancelled',
             Reservation.status == 'Rejected'
@@ -872,30 +824,18 @@ def statistics():
         func.sum(Reservation.parking_cost).label('total_spending')
     ).join(ParkingSpot, ParkingSpot.id == Reservation.spot_id)\
      .join(ParkingLot, ParkingLot.id == ParkingSpot.lot_id)\
-     .filter(Reservation.user_id == current_user.id,
+     .filter(Reservation.user_id == user_id,
              Reservation.status.in_(['Parked Out']))\
      .group_by(ParkingLot.id)\
      .all()
 
-    # Debug prints
-    print(f"Spending data for user {current_user.id}: {spending_data}")
-    
-    # Prepare spending info
-    locations = [item[0] for item in spending_data] if spending_data else ["No data"]
-    total_spending = [float(item[1]) if spending_data else 0 for item in spending_data]  # Convert to float for Chart.js
-
-    spending_info = {
-        'locations': locations,
-        'total_spending': total_spending
-    }
-
     # Frequent locations 
     frequent_locations = db.session.query(
         ParkingLot.prime_location_name,
         func.count(Reservation.id).label('reservation_count')
     ).join(ParkingSpot, ParkingSpot.id == Reservation.spot_id)\
      .join(ParkingLot, ParkingLot.id == ParkingSpot.lot_id)\
-     .filter(Reservation.user_id == current_user.id)\
+     .filter(Reservation.user_id == user_id)\
      .group_by(ParkingLot.id)\
      .order_by(func.count(Reservation.id).desc())\
      .all()
@@ -905,11 +845,37 @@ def statistics():
         Vehicle.vehicle_name,
         func.count(Reservation.id).label('reservation_count')
     ).join(Reservation, Reservation.vehicle_id == Vehicle.id)\
-     .filter(Reservation.user_id == current_user.id)\
+     .filter(Reservation.user_id == user_id)\
      .group_by(Vehicle.id)\
      .order_by(func.count(Reservation.id).desc())\
      .all()
 
+    return status_data, spending_data, frequent_locations, vehicle_usage
+
+
+@user_bp.route('/stats', methods=['GET'])
+@login_required
+def statistics():
+    if rollups_are_fresh(current_app.config['ROLLUP_MAX_AGE']):
+        status_counts, spending_data, frequent_locations, vehicle_usage = user_chart_rows(current_user.id)
+        status_data = {
+            'pending': status_counts.get('Pending', 0),
+            'confirmed': status_counts.get('Confirmed', 0),
+            'parked_out': status_counts.get('Parked Out', 0),
+            'cancelled_rejected': status_counts.get('Cancelled', 0) + status_counts.get('Rejected', 0)
+        }
+    else:
+        status_data, spending_data, frequent_locations, vehicle_usage = live_user_chart_rows(current_user.id)
+
+    # Prepare spending info
+    locations = [item[0] for item in spending_data] if spending_data else ["No data"]
+    total_spending = [float(item[1]) if spending_data else 0 for item in spending_data]  # Convert to float for Chart.js
+
+    spending_info = {
+        'locations': locations,
+        'total_spending': total_spending
+    }
+
     # Prepare all data for template
     frequent_info = {
         'locations': [item[0] for item in frequent_locations] if frequent_locations else ["No data"],
@@ -0,0 +1,142 @@
+import re
+
+from sqlalchemy import event
+
+from model import *
+
+# entity name used by the admin search template -> model and indexed text
+INDEXED = {
+    'users': (User, lambda u: [u.firstname, u.lastname, u.email, u.username, u.phone]),
+    'location': (Location, lambda l: [l.name, l.address, l.pin_code]),
+    'parkinglot': (ParkingLot, lambda p: [p.prime_location_name]),
+    'reservations': (Reservation, lambda r: [str(r.id), r.booking_id, r.status]),
+}
+ENTITY_OF = {model: entity for entity, (model, _) in INDEXED.items()}
+
+# FTS rowids pack the entity into the low bits so updates hit the rowid index
+ENTITY_CODES = {entity: code for code, entity in enumerate(INDEXED)}
+ENTITY_NAMES = list(INDEXED)
+
+
+def _rowid(entity, entity_id):
+    return entity_id * len(ENTITY_NAMES) + ENTITY_CODES[entity]
+
+
+_enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def _body(entity, obj):
+    return ' '.join(str(value) for value in INDEXED[entity][1](obj) if value)
+
+
+def ensure_search_index():
+    """Create the FTS5 table if the database supports it, filling it on first run."""
+    global _enabled
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    with db.engine.begin() as conn:
+        exists = conn.execute(db.text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_index'"
+        )).first()
+        if not exists:
+            try:
+                conn.execute(db.text(
+                    "CREATE VIRTUAL TABLE search_index USING fts5(body, prefix='2 3')"
+                ))
+            except Exception:
+                return False  # SQLite built without FTS5
+    _enabled = True
+    if not exists:
+        reindex()
+    return True
+
+
+def reindex():
+    """Rebuild the whole search index from the indexed tables."""
+    db.session.execute(db.text("DELETE FROM search_index"))
+    for entity, (model, _) in INDEXED.items():
+        rows = [{'rowid': _rowid(entity, obj.id), 'body': _body(entity, obj)}
+                for obj in model.query.yield_per(1000)]
+        if rows:
+            db.session.execute(db.text(
+                "INSERT INTO search_index (rowid, body) VALUES (:rowid, :body)"
+            ), rows)
+    db.session.commit()
+
+
+def refresh_entities(entity, ids):
+    """Re-index rows changed by bulk UPDATEs, which skip the flush listener."""
+    if not _enabled or not ids:
+        return
+    model = INDEXED[entity][0]
+    rows = [{'rowid': _rowid(entity, obj.id), 'body': _body(entity, obj)}
+            for obj in model.query.filter(model.id.in_(ids))]
+    db.session.execute(db.text("DELETE FROM search_index WHERE rowid = :rowid"),
+                       [{'rowid': _rowid(entity, obj_id)} for obj_id in ids])
+    if rows:
+        db.session.execute(db.text("INSERT INTO search_index (rowid, body) VALUES (:rowid, :body)"), rows)
+
+
+def _match_expression(query):
+    # Every word must match, each as a prefix; quoting keeps FTS syntax inert
+    words = re.findall(r'\w+', query or '')
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def search(query, page=1, per_page=25):
+    """Ranked search across users, locations, lots and reservations.
+
+    Returns (results, total) where results is a list of
+    {'entity': ..., 'result': model instance} for the requested page.
+    """
+    match = _match_expression(query)
+    if not match:
+        return [], 0
+
+    total = db.session.execute(db.text(
+        "SELECT count(*) FROM search_index WHERE search_index MATCH :match"
+    ), {'match': match}).scalar()
+    rowids = db.session.execute(db.text(
+        "SELECT rowid FROM search_index WHERE search_index MATCH :match "
+        "ORDER BY rank LIMIT :limit OFFSET :offset"
+    ), {'match': match, 'limit': per_page, 'offset': (page - 1) * per_page}).scalars().all()
+    rows = [(ENTITY_NAMES[rowid % len(ENTITY_NAMES)], rowid // len(ENTITY_NAMES)) for rowid in rowids]
+
+    # One query per entity type for the whole page
+    ids = {}
+    for entity, entity_id in rows:
+        ids.setdefault(entity, []).append(entity_id)
+    loaded = {}
+    for entity, entity_ids in ids.items():
+        model = INDEXED[entity][0]
+        for obj in model.query.filter(model.id.in_(entity_ids)):
+            loaded[(entity, obj.id)] = obj
+
+    results = [{'entity': entity, 'result': loaded[(entity, entity_id)]}
+               for entity, entity_id in rows if (entity, entity_id) in loaded]
+    return results, total
+
+
+@event.listens_for(db.session, 'after_flush')
+def _sync_search_index(session, flush_context):
+    if not _enabled:
+        return
+    stale, fresh = [], []
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        entity = ENTITY_OF.get(type(obj))
+        if entity is None:
+            continue
+        rowid = _rowid(entity, obj.id)
+        stale.append({'rowid': rowid})
+        if obj not in session.deleted:
+            fresh.append({'rowid': rowid, 'body': _body(entity, obj)})
+
+    connection = session.connection()
+    if stale:
+        connection.execute(db.text("DELETE FROM search_index WHERE rowid = :rowid"), stale)
+    if fresh:
+        connection.execute(db.text("INSERT INTO search_index (rowid, body) VALUES (:rowid, :body)"), fresh)
@@ -0,0 +1,278 @@
+from bisect import bisect_left, insort
+from threading import RLock
+import time
+
+from sqlalchemy import event, exists, and_
+
+from model import *
+
+# Reservations in these states still hold their spot for [arrival, departure)
+BLOCKING_STATUSES = ('Pending', 'Confirmed', 'Parked')
+
+INDEX_TTL = 30  # seconds before a lot index is rebuilt from the database
+
+
+class SpotIntervals:
+    """Booked intervals of a single spot, sorted by arrival time.
+
+    ``max_ends[i]`` is the latest departure among the first ``i + 1``
+    intervals, so an overlap check is a single bisect.
+    """
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.reservation_ids = []
+        self.max_ends = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _rebuild_max_ends(self, start=0):
+        running = self.max_ends[start - 1] if start else None
+        del self.max_ends[start:]
+        for end in self.ends[start:]:
+            running = end if running is None or end > running else running
+            self.max_ends.append(running)
+
+    def add(self, reservation_id, arrival, departure):
+        i = bisect_left(self.starts, arrival)
+        self.starts.insert(i, arrival)
+        self.ends.insert(i, departure)
+        self.reservation_ids.insert(i, reservation_id)
+        self._rebuild_max_ends(i)
+
+    def remove(self, reservation_id):
+        try:
+            i = self.reservation_ids.index(reservation_id)
+        except ValueError:
+            return
+        del self.starts[i], self.ends[i], self.reservation_ids[i]
+        self._rebuild_max_ends(i)
+
+    def conflicts(self, arrival, departure):
+        # Intervals starting before our departure overlap us if any of them
+        # ends after our arrival.
+        i = bisect_left(self.starts, departure)
+        return i > 0 and self.max_ends[i - 1] > arrival
+
+
+class LotIndex:
+    """Booked intervals of every bookable spot of one parking lot.
+
+    Spots with no bookings are kept apart (``idle``) so they cost nothing
+    to skip, but spots with bookings are still tried one by one; see
+    first_free.
+    """
+
+    def __init__(self, lot_id, spot_ids):
+        self.lot_id = lot_id
+        self.built_at = time.monotonic()
+        self.spot_ids = list(spot_ids)  # allocation order
+        self.position = {spot_id: pos for pos, spot_id in enumerate(self.spot_ids)}
+        self.intervals = {spot_id: SpotIntervals() for spot_id in self.spot_ids}
+        self.idle = list(range(len(self.spot_ids)))  # positions with no intervals
+        self.busy = []  # positions with at least one interval
+        self.by_reservation = {}
+
+    def _mark(self, pos, busy):
+        src, dst = (self.idle, self.busy) if busy else (self.busy, self.idle)
+        i = bisect_left(src, pos)
+        if i < len(src) and src[i] == pos:
+            del src[i]
+            insort(dst, pos)
+
+    def add(self, reservation_id, spot_id, arrival, departure):
+        self.remove(reservation_id)
+        if spot_id not in self.intervals:
+            return
+        self.intervals[spot_id].add(reservation_id, arrival, departure)
+        self.by_reservation[reservation_id] = spot_id
+        self._mark(self.position[spot_id], busy=True)
+
+    def remove(self, reservation_id):
+        spot_id = self.by_reservation.pop(reservation_id, None)
+        if spot_id is None:
+            return
+        intervals = self.intervals[spot_id]
+        intervals.remove(reservation_id)
+        if not intervals:
+            self._mark(self.position[spot_id], busy=False)
+
+    def first_free(self, arrival, departure):
+        """Return the first spot id free for [arrival, departure), or None.
+
+        Linear in the lot: each spot with bookings ahead of the first idle
+        spot gets an O(log k) overlap test (k = its bookings), so a busy lot
+        costs O(spots * log k). It beats re-reading every spot's
+        reservations from the database, but it is a scan. Finding the
+        lowest-numbered spot with a gap for the window can't be done
+        sub-linearly without giving up gap fits.
+        """
+        first_idle = self.idle[0] if self.idle else len(self.spot_ids)
+        for pos in self.busy:
+            if pos > first_idle:
+                break
+            spot_id = self.spot_ids[pos]
+            if not self.intervals[spot_id].conflicts(arrival, departure):
+                return spot_id
+        return self.spot_ids[first_idle] if self.idle else None
+
+
+_lock = RLock()
+_indexes = {}
+
+
+def _build(lot_id):
+    spot_ids = [spot_id for (spot_id,) in db.session.query(ParkingSpot.id).filter(
+        ParkingSpot.lot_id == lot_id,
+        ParkingSpot.status != 'X'
+    ).order_by(ParkingSpot.id)]
+
+    index = LotIndex(lot_id, spot_ids)
+    rows = db.session.query(
+        Reservation.id, Reservation.spot_id,
+        Reservation.expected_arrival, Reservation.expected_departure
+    ).join(ParkingSpot, ParkingSpot.id == Reservation.spot_id).filter(
+        ParkingSpot.lot_id == lot_id,
+        Reservation.status.in_(BLOCKING_STATUSES)
+    )
+    for reservation_id, spot_id, arrival, departure in rows:
+        index.add(reservation_id, spot_id, arrival, departure)
+    return index
+
+
+def get_lot_index(lot_id):
+    with _lock:
+        index = _indexes.get(lot_id)
+        if index is None or time.monotonic() - index.built_at > INDEX_TTL:
+            index = _indexes[lot_id] = _build(lot_id)
+        return index
+
+
+def invalidate(lot_id=None):
+    with _lock:
+        if lot_id is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(lot_id, None)
+
+
+def spot_has_conflict(spot_id, arrival, departure):
+    return db.session.query(Reservation.id).filter(
+        Reservation.spot_id == spot_id,
+        Reservation.status.in_(BLOCKING_STATUSES),
+        Reservation.expected_arrival < departure,
+        Reservation.expected_departure > arrival
+    ).first() is not None
+
+
+def _first_free_in_db(lot_id, arrival, departure):
+    """The first spot of the lot free for [arrival, departure), asked of the database."""
+    row = db.session.query(ParkingSpot.id).filter(
+        ParkingSpot.lot_id == lot_id,
+        ParkingSpot.status != 'X',
+        ~exists().where(and_(
+            Reservation.spot_id == ParkingSpot.id,
+            Reservation.status.in_(BLOCKING_STATUSES),
+            Reservation.expected_arrival < departure,
+            Reservation.expected_departure > arrival
+        ))
+    ).order_by(ParkingSpot.id).first()
+    return row[0] if row else None
+
+
+def spot_is_held(spot_id):
+    """Whether any reservation still holds the spot, now or later."""
+    return db.session.query(Reservation.id).filter(
+        Reservation.spot_id == spot_id,
+        Reservation.status.in_(BLOCKING_STATUSES)
+    ).first() is not None
+
+
+def claim_free_spot(lot_id, arrival, departure):
+    """Book the first spot of the lot free for [arrival, departure).
+
+    The spot row (and its version) is read before the database overlap
+    check, and claimed against that version, so a booking another worker
+    commits in between makes our claim fail rather than double book. Lost
+    races rebuild the index and try again, a bounded number of times.
+    The index lags spots freed by other workers (or outside the app), so
+    before reporting the lot full the database is asked too.
+    Returns the claimed ParkingSpot, or None if the lot is full.
+    """
+    for _ in range(ParkingSpot.CLAIM_ATTEMPTS):
+        with _lock:
+            spot_id = get_lot_index(lot_id).first_free(arrival, departure)
+        if spot_id is None:
+            spot_id = _first_free_in_db(lot_id, arrival, departure)
+            if spot_id is None:
+                return None
+            invalidate(lot_id)
+        spot = db.session.get(ParkingSpot, spot_id, populate_existing=True)
+        if spot is not None and not spot_has_conflict(spot_id, arrival, departure):
+            try:
+                # An occupied spot stays occupied; the booking is for later
+                spot.claim('B' if spot.status == 'A' else spot.status, expected=('A', 'B', 'O'))
+                return spot
+            except SpotClaimConflict:
+                pass
+        invalidate(lot_id)
+    return None
+
+
+# Keep indexes in step with committed reservation changes
+
+def _pending(session):
+    return session.info.setdefault('spot_index_pending', {})
+
+
+@event.listens_for(db.session, 'after_flush')
+def _record_changes(session, flush_context):
+    pending = _pending(session)
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, ParkingSpot) and obj in session.new:
+            pending[('spot', obj.id)] = obj.lot_id
+        elif isinstance(obj, Reservation):
+            pending[('reservation', obj.id)] = (
+                obj.lot_id, obj.spot_id, obj.status,
+                obj.expected_arrival, obj.expected_departure
+            )
+    for obj in session.deleted:
+        if isinstance(obj, Reservation):
+            pending[('reservation', obj.id)] = (obj.lot_id, None, None, None, None)
+        elif isinstance(obj, ParkingSpot):
+            pending[('spot', obj.id)] = obj.lot_id
+
+
+@event.listens_for(db.session, 'after_commit')
+def _apply_changes(session):
+    pending = session.info.pop('spot_index_pending', {})
+    soft_deleted = session.info.pop('spot_layout_changed', set())
+    with _lock:
+        for lot_id in soft_deleted:
+            _indexes.pop(lot_id, None)
+        for (kind, obj_id), change in pending.items():
+            if kind == 'spot':
+                # Spots added or removed change the lot layout
+                _indexes.pop(change, None)
+                continue
+            lot_id, spot_id, status, arrival, departure = change
+            index = _indexes.get(lot_id)
+            if index is None:
+                continue
+            if spot_id is not None and status in BLOCKING_STATUSES:
+                index.add(obj_id, spot_id, arrival, departure)
+            else:
+                index.remove(obj_id)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_changes(session):
+    pending = session.info.pop('spot_index_pending', {})
+    soft_deleted = session.info.pop('spot_layout_changed', set())
+    with _lock:
+        for lot_id in soft_deleted:
+            _indexes.pop(lot_id, None)
+        for (kind, obj_id), change in pending.items():
+            _indexes.pop(change if kind == 'spot' else change[0], None)
@@ -0,0 +1,116 @@
+from collections import Counter, deque
+from datetime import datetime
+from threading import Lock
+import re
+import time
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+
+from model import *
+
+# Bind lists and literals vary between otherwise identical statements
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_SPACE = re.compile(r'\s+')
+
+_history = deque(maxlen=200)  # summaries of recent profiled requests
+_lock = Lock()
+settings = {'enabled': False, 'n_plus_one': 5}
+
+
+def statement_shape(statement):
+    return _SPACE.sub(' ', _IN_LIST.sub('(?...)', statement)).strip()
+
+
+class RequestProfile:
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.shapes = Counter()
+        self.shape_seconds = Counter()
+
+    def record(self, statement, seconds):
+        shape = statement_shape(statement)
+        self.queries += 1
+        self.seconds += seconds
+        self.shapes[shape] += 1
+        self.shape_seconds[shape] += seconds
+
+    def n_plus_one(self, threshold):
+        """Statement shapes run at least ``threshold`` times, most repeated first."""
+        return [(shape, count, self.shape_seconds[shape])
+                for shape, count in self.shapes.most_common() if count >= threshold]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('sql_profiler_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['sql_profiler_started'].pop()
+    # Background threads (scheduler, live broker) have no request to charge
+    if has_request_context() and 'sql_profile' in g:
+        g.sql_profile.record(statement, time.perf_counter() - started)
+
+
+def _handle_error(exception_context):
+    # Failed statements never reach after_cursor_execute
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('sql_profiler_started'):
+        connection.info['sql_profiler_started'].pop()
+
+
+def _start_profile():
+    g.sql_profile = RequestProfile()
+
+
+def _finish_profile(response):
+    profile = g.pop('sql_profile', None)
+    if profile is None:
+        return response
+    suspects = profile.n_plus_one(settings['n_plus_one'])
+    milliseconds = round(profile.seconds * 1000, 2)
+    response.headers['X-SQL-Queries'] = str(profile.queries)
+    response.headers['X-SQL-Time'] = f'{milliseconds}ms'
+    response.headers['X-SQL-N-Plus-One'] = str(len(suspects))
+    response.headers.add('Server-Timing', f'db;dur={milliseconds};desc="{profile.queries} queries"')
+    with _lock:
+        _history.append({
+            'at': datetime.now(),
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'queries': profile.queries,
+            'milliseconds': milliseconds,
+            'suspects': [{'shape': shape, 'count': count, 'milliseconds': round(seconds * 1000, 2)}
+                         for shape, count, seconds in suspects[:5]],
+        })
+    return response
+
+
+def worst_requests(limit=50):
+    """Recent profiled requests, most queries first."""
+    with _lock:
+        requests = list(_history)
+    return sorted(requests, key=lambda entry: (entry['queries'], entry['milliseconds']), reverse=True)[:limit]
+
+
+def init_app(app):
+    """Profile every request's SQL when SQL_PROFILER is on.
+
+    Each response gets X-SQL-Queries, X-SQL-Time, X-SQL-N-Plus-One and a
+    Server-Timing entry; the admin SQL profiler page lists the worst of
+    the recent requests. A statement shape repeated SQL_PROFILER_N_PLUS_ONE
+    times in one request is reported as a likely N+1.
+    """
+    settings['enabled'] = app.config['SQL_PROFILER']
+    settings['n_plus_one'] = app.config['SQL_PROFILER_N_PLUS_ONE']
+    if not settings['enabled']:
+        return
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(db.engine, 'handle_error', _handle_error)
+    app.before_request(_start_profile)
+    app.after_request(_finish_profile)
@@ -0,0 +1,176 @@
+from datetime import datetime, timedelta
+from threading import Thread, Event, Lock
+import time
+
+from sqlalchemy import update, exists, and_
+
+from model import *
+from utils import promote_pending_reservations
+from rollups import refresh_rollups
+import search_index
+import spot_index
+
+NO_SHOW_GRACE = timedelta(minutes=30)  # same window park() allows a late arrival
+
+# Totals since the process started, plus the outcome of the last sweep
+sweep_stats = {
+    'runs': 0,
+    'no_shows_rejected': 0,
+    'pending_expired': 0,
+    'spots_released': 0,
+    'promoted': 0,
+    'last_run': None,
+    'last_duration_seconds': 0.0,
+    'last_reclaimed': 0,
+}
+
+
+def _reject(ids, conditions, reason, now):
+    """Reject those of ``ids`` that still match ``conditions``.
+
+    The conditions repeat the selecting query's, so a reservation that
+    moved on in between (e.g. was parked) is left alone. Returns the
+    (id, spot_id, lot_id) rows actually rejected.
+    """
+    rows = db.session.execute(
+        update(Reservation)
+        .where(Reservation.id.in_(ids), *conditions)
+        .values(status='Rejected', cancellation_reason=reason, updated_at=now)
+        .returning(Reservation.id, Reservation.spot_id, Reservation.lot_id),
+        execution_options={'synchronize_session': False}
+    ).all()
+    search_index.refresh_entities('reservations', [row.id for row in rows])
+    return rows
+
+
+def sweep(now=None, batch_size=500):
+    """Reject no-shows, expire stale Pending requests and recycle their spots.
+
+    Works in set-based batches of ``batch_size`` reservations and commits
+    after each batch. Returns the counts reclaimed by this run.
+    """
+    now = now or datetime.now()
+    started = time.monotonic()
+    result = {'no_shows_rejected': 0, 'pending_expired': 0, 'spots_released': 0, 'promoted': 0}
+
+    # Confirmed bookings whose holder never showed up
+    no_show = (
+        Reservation.status == 'Confirmed',
+        Reservation.parking_timestamp.is_(None),
+        Reservation.expected_arrival < now - NO_SHOW_GRACE
+    )
+    while True:
+        ids = [res_id for (res_id,) in db.session.query(Reservation.id).filter(*no_show).limit(batch_size)]
+        if not ids:
+            break
+
+        rows = _reject(ids, no_show, 'Showed up too late.', now)
+        result['no_shows_rejected'] += len(rows)
+
+        # Free their spots unless another booking still holds them
+        spot_ids = {row.spot_id for row in rows if row.spot_id}
+        released_ids = [spot_id for (spot_id,) in db.session.execute(
+            update(ParkingSpot).where(
+                ParkingSpot.id.in_(spot_ids),
+                ParkingSpot.status == 'B',
+                ~exists().where(and_(Reservation.spot_id == ParkingSpot.id,
+                                     Reservation.status.in_(spot_index.BLOCKING_STATUSES)))
+            ).values(status='A', version=ParkingSpot.version + 1).returning(ParkingSpot.id),
+            execution_options={'synchronize_session': False}
+        )] if spot_ids else []
+        lot_ids = {row.lot_id for row in rows}
+        result['spots_released'] += len(released_ids)
+
+        db.session.expire_all()
+        for lot in ParkingLot.query.filter(ParkingLot.id.in_(lot_ids)):
+            lot.recount_spots()
+
+        # Hand the released spots straight to the waitlist
+        released = ParkingSpot.query.filter(ParkingSpot.id.in_(released_ids)).order_by(ParkingSpot.id).all()
+        for lot_id in lot_ids:
+            lot_spots = [spot for spot in released if spot.lot_id == lot_id]
+            result['promoted'] += len(promote_pending_reservations(lot_id, lot_spots, now=now))
+
+        db.session.commit()
+        for lot_id in lot_ids:
+            spot_index.invalidate(lot_id)
+
+    # Pending requests whose window closed before a spot freed up
+    expired = (
+        Reservation.status == 'Pending',
+        Reservation.spot_id.is_(None),
+        Reservation.expected_departure < now
+    )
+    while True:
+        ids = [res_id for (res_id,) in db.session.query(Reservation.id).filter(*expired).limit(batch_size)]
+        if not ids:
+            break
+        rows = _reject(ids, expired, 'Request expired before a spot became available.', now)
+        db.session.commit()
+        result['pending_expired'] += len(rows)
+
+    sweep_stats['runs'] += 1
+    for key, count in result.items():
+        sweep_stats[key] += count
+    sweep_stats['last_run'] = now
+    sweep_stats['last_duration_seconds'] = round(time.monotonic() - started, 4)
+    sweep_stats['last_reclaimed'] = result['no_shows_rejected'] + result['pending_expired']
+    return result
+
+
+class Scheduler:
+    """Runs the sweeper (and the rollup refresh) on a background thread.
+
+    Started on the first request so CLI commands and tests never spawn it.
+    Intervals come from SWEEPER_INTERVAL and ROLLUP_REFRESH_INTERVAL;
+    0 disables a job.
+    """
+
+    def __init__(self):
+        self._started = False
+        self._lock = Lock()
+        self._stop = Event()
+
+    def init_app(self, app):
+        @app.before_request
+        def _start_scheduler():
+            if not self._started and not app.testing:
+                self.start(app)
+
+    def start(self, app):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        jobs = [
+            (app.config['SWEEPER_INTERVAL'], self._run_sweep),
+            (app.config['ROLLUP_REFRESH_INTERVAL'], self._run_rollups),
+        ]
+        for interval, job in jobs:
+            if interval > 0:
+                Thread(target=self._loop, args=(app, interval, job), daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self, app, interval, job):
+        while not self._stop.wait(interval):
+            with app.app_context():
+                try:
+                    job(app)
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception("Background job %s failed", job.__name__)
+                finally:
+                    db.session.remove()
+
+    def _run_sweep(self, app):
+        result = sweep(batch_size=app.config['SWEEPER_BATCH_SIZE'])
+        if any(result.values()):
+            app.logger.info("Sweeper reclaimed %s", result)
+
+    def _run_rollups(self, app):
+        refresh_rollups()
+
+
+scheduler = Scheduler()
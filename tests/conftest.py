@@ -0,0 +1,65 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.py configures itself from the environment at import time
+_db_dir = tempfile.mkdtemp()
+os.environ['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(_db_dir, "test.db")}'
+os.environ['SECRET_KEY'] = 'test'
+os.environ['ASSETS_BUILD_ON_START'] = 'false'
+os.chdir(ROOT)
+
+from app import app as flask_app  # noqa: E402
+from model import *  # noqa: E402,F403
+from user_cache import user_cache  # noqa: E402
+import spot_index  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    flask_app.config['TESTING'] = True
+    with flask_app.app_context():
+        yield flask_app
+        db.session.rollback()
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+        # Row ids are reused between tests, so drop what the process cached about them
+        spot_index.invalidate()
+        user_cache.clear()
+
+
+@pytest.fixture
+def lot(app):
+    location = Location(name='Test', address='1 Test Road')
+    db.session.add(location)
+    db.session.flush()
+    lot = ParkingLot(prime_location_name='Test lot', price_per_hour=10, max_parking_spots=1,
+                     available_spots=1, location_id=location.id, is_active=True)
+    db.session.add(lot)
+    db.session.flush()
+    lot.add_spots(1)
+    db.session.commit()
+    return lot
+
+
+@pytest.fixture
+def user(app):
+    user = User(email='driver@example.com', password='x', firstname='Test', is_active=True)
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+@pytest.fixture
+def client(app, user):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+    return client
@@ -0,0 +1,25 @@
+from datetime import datetime, timedelta
+
+from model import *
+from spot_index import claim_free_spot, get_lot_index
+
+
+def test_claim_sees_a_spot_freed_outside_this_process(lot, user):
+    spot = ParkingSpot.query.filter_by(lot_id=lot.id).one()
+    arrival = datetime.now() + timedelta(hours=1)
+    db.session.add(Reservation(
+        booking_id='BK-1', lot_id=lot.id, spot_id=spot.id, user_id=user.id, status='Confirmed',
+        booking_timestamp=datetime.now(), expected_arrival=arrival, expected_departure=arrival + timedelta(hours=1)
+    ))
+    spot.set_status('B', expected=('A',))
+    db.session.commit()
+    assert get_lot_index(lot.id).first_free(arrival, arrival + timedelta(hours=1)) is None
+
+    # Another worker cancels the booking; this process's index never hears of it
+    with db.engine.begin() as conn:
+        conn.execute(db.text("UPDATE reservation SET status = 'Cancelled' WHERE booking_id = 'BK-1'"))
+        conn.execute(db.text("UPDATE parking_spot SET status = 'A', version = version + 1 WHERE id = :id"),
+                     {'id': spot.id})
+
+    claimed = claim_free_spot(lot.id, arrival, arrival + timedelta(hours=1))
+    assert claimed is not None and claimed.id == spot.id
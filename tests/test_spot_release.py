@@ -0,0 +1,34 @@
+from datetime import datetime, timedelta
+
+from model import *
+
+
+def _book(lot, spot, user, booking_id, arrival):
+    reservation = Reservation(
+        booking_id=booking_id, lot_id=lot.id, spot_id=spot.id, user_id=user.id, status='Confirmed',
+        booking_timestamp=datetime.now(), expected_arrival=arrival, expected_departure=arrival + timedelta(hours=1)
+    )
+    db.session.add(reservation)
+    return reservation
+
+
+def test_cancelling_one_of_two_bookings_keeps_the_spot_booked(lot, user, client):
+    spot = ParkingSpot.query.filter_by(lot_id=lot.id).one()
+    start = datetime.now() + timedelta(hours=2)
+    _book(lot, spot, user, 'BK-1', start)
+    _book(lot, spot, user, 'BK-2', start + timedelta(hours=3))
+    spot.set_status('B', expected=('A',))
+    db.session.commit()
+
+    client.get('/user/cancel_booking/BK-1')
+    db.session.expire_all()
+    spot, lot = db.session.get(ParkingSpot, spot.id), db.session.get(ParkingLot, lot.id)
+    assert Reservation.query.filter_by(booking_id='BK-1').one().status == 'Cancelled'
+    assert spot.status == 'B'
+    assert (lot.free_count, lot.booked_count, lot.occupied_count) == (0, 1, 0)
+
+    client.get('/user/cancel_booking/BK-2')
+    db.session.expire_all()
+    spot, lot = db.session.get(ParkingSpot, spot.id), db.session.get(ParkingLot, lot.id)
+    assert spot.status == 'A'
+    assert (lot.free_count, lot.booked_count, lot.occupied_count) == (1, 0, 0)
@@ -0,0 +1,78 @@
+from flask import current_app, request
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import make_transient_to_detached
+
+from model import *
+from cache import TTLCache
+
+# user id -> detached User snapshot holding only the column values
+user_cache = TTLCache(maxsize=1024)
+
+# Requests that only read are served from the snapshot as is
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def _snapshot(user):
+    # A detached copy no session ever owns, so requests can't share (or
+    # mutate) the same instance; every request merges its own copy.
+    snapshot = User(**{attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs})
+    make_transient_to_detached(snapshot)
+    return snapshot
+
+
+def _still_valid(snapshot):
+    # Two columns by primary key: far cheaper than loading the user
+    row = db.session.execute(select(User.is_active, User.flagged).where(User.id == snapshot.id)).first()
+    return row is not None and tuple(row) == (snapshot.is_active, snapshot.flagged)
+
+
+def load_user(user_id):
+    """The user for Flask-Login, merged from the cache without a SELECT on a hit.
+
+    Commits only evict the snapshot in the worker that made them, so other
+    workers can keep serving a flagged, deactivated or deleted user for up
+    to USER_CACHE_TTL. That is tolerated for GET/HEAD/OPTIONS requests; any
+    other request (booking a spot, for one) first checks the snapshot's
+    is_active and flagged against the database.
+    """
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+
+    snapshot = user_cache.get(user_id)
+    if snapshot is not None:
+        if request.method in SAFE_METHODS or _still_valid(snapshot):
+            return db.session.merge(snapshot, load=False)
+        forget_user(user_id)
+
+    user = db.session.get(User, user_id)
+    if user is not None:
+        user_cache.set(user_id, _snapshot(user), ttl=current_app.config['USER_CACHE_TTL'])
+    return user
+
+
+def forget_user(user_id):
+    user_cache.delete(int(user_id))
+
+
+@event.listens_for(db.session, 'after_flush')
+def _record_changed_users(session, flush_context):
+    changed = session.info.setdefault('changed_users', set())
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            changed.add(obj.id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _evict_changed_users(session):
+    for user_id in session.info.pop('changed_users', ()):
+        forget_user(user_id)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_changed_users(session):
+    # The rollback may have undone a change another request already read;
+    # evicting is always safe.
+    for user_id in session.info.pop('changed_users', ()):
+        forget_user(user_id)
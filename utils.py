@@ -1,4 +1,5 @@
 from model import *
+from spot_index import spot_has_conflict, spot_is_held
 
 def calculate_duration(start_time):
     now = datetime.now()  
@@ -16,18 +17,134 @@ def parse_time_string(time_str):
             continue
     raise ValueError(f"Time data '{time_str}' is not in a recognized format")
 
-def assign_pending_reservation(spot):
-    now = datetime.now()
-    matching_request = Reservation.query.filter(
-        Reservation.spot_id.is_(None),  # Not yet assigned
+def promote_pending_reservations(lot_id, spots, now=None):
+    """Hand freed spots of a lot to the longest-waiting Pending requests.
+
+    The Pending rows of a lot form its waitlist, read in arrival order
+    through the ix_reservation_waitlist index. Up to len(spots) requests
+    whose window covers ``now`` are confirmed in one pass, each on a spot
+    none of whose other bookings overlaps its window. Nothing is
+    committed; the promotion rides on the caller's transaction.
+    """
+    spots = [spot for spot in spots if spot.status == 'A']
+    if not spots:
+        return []
+
+    now = now or datetime.now()
+    waiting = Reservation.query.filter(
+        Reservation.lot_id == lot_id,  # Same lot
         Reservation.status == 'Pending',
         Reservation.expected_arrival <= now,
         Reservation.expected_departure >= now,
-        Reservation.lot_id == spot.lot_id  # Same lot
-    ).order_by(Reservation.expected_arrival.asc()).first()
-
-    if matching_request:
-        matching_request.spot_id = spot.id
-        matching_request.status = 'Confirmed'
-        spot.status = 'B'  # Or 'O' if you're directly allowing parking
-        db.session.commit()
+        Reservation.spot_id.is_(None)  # Not yet assigned
+    ).order_by(Reservation.expected_arrival.asc()).limit(len(spots)).all()
+
+    promoted = []
+    for request in waiting:
+        if not spots:
+            break
+        spot = None
+        for candidate in list(spots):
+            # A freed spot can still carry later bookings that clash with this request
+            if spot_has_conflict(candidate.id, request.expected_arrival, request.expected_departure):
+                continue
+            spots.remove(candidate)
+            # Spots claimed by someone else in the meantime are skipped
+            if candidate.set_status('B', expected=('A',)):
+                spot = candidate
+                break
+        if spot is None:
+            continue
+        request.spot_id = spot.id
+        request.status = 'Confirmed'
+        promoted.append(request)
+    return promoted
+
+
+def assign_pending_reservation(spot):
+    return promote_pending_reservations(spot.lot_id, [spot])
+
+
+def release_spot(spot, expected=('B',)):
+    """Let go of a spot whose reservation just ended, was cancelled or rejected.
+
+    Another Pending, Confirmed or Parked reservation may still hold the spot;
+    then it stays (or becomes) booked. Otherwise it is freed and handed to
+    the waitlist. Only acts while the spot is in one of the ``expected``
+    statuses. Call it after the reservation's status has changed.
+    """
+    if spot_is_held(spot.id):
+        if spot.status != 'B':
+            spot.set_status('B', expected=expected)
+        return []
+    if spot.set_status('A', expected=expected):
+        return assign_pending_reservation(spot)
+    return []
+
+
+def upgrade_schema():
+    """Add columns and indexes that exist on the models but not yet in the database.
+
+    db.create_all() only creates missing tables, so databases created by an
+    older version of the app need the newer columns added in place.
+    Returns the set of "table.column" names that were added.
+    """
+    inspector = db.inspect(db.engine)
+    added = set()
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {col['name'] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(db.engine.dialect)}'
+                if column.server_default is not None:
+                    ddl += f" NOT NULL DEFAULT '{column.server_default.arg}'" if not column.nullable \
+                        else f" DEFAULT '{column.server_default.arg}'"
+                conn.execute(db.text(ddl))
+                added.add(f'{table.name}.{column.name}')
+
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(conn)
+    return added
+
+
+def sync_user_flags():
+    """Rebuild every user's denormalized flag columns from the Flag table."""
+    latest = {}
+    for flag in Flag.query.order_by(Flag.user_id, Flag.flag_date.desc(), Flag.id.desc()):
+        latest.setdefault(flag.user_id, flag)
+
+    repaired = 0
+    for user in User.query.all():
+        flag = latest.get(user.id)
+        flagged = bool(flag and flag.is_flagged)
+        values = (flagged, flag.reason if flagged else None, flag.flag_date if flagged else None)
+        if (user.flagged, user.flag_reason, user.flagged_at) != values:
+            user.flagged, user.flag_reason, user.flagged_at = values
+            repaired += 1
+    db.session.commit()
+    return repaired
+
+
+def recount_lot_counters():
+    """Recompute every lot's occupied/booked/free counters from its spots."""
+    counts = {}
+    for lot_id, status, count in db.session.query(
+        ParkingSpot.lot_id, ParkingSpot.status, func.count(ParkingSpot.id)
+    ).group_by(ParkingSpot.lot_id, ParkingSpot.status):
+        counts.setdefault(lot_id, {})[status] = count
+
+    repaired = 0
+    for lot in ParkingLot.query.all():
+        lot_counts = counts.get(lot.id, {})
+        values = (lot_counts.get('O', 0), lot_counts.get('B', 0), lot_counts.get('A', 0))
+        if (lot.occupied_count, lot.booked_count, lot.free_count) != values:
+            lot.occupied_count, lot.booked_count, lot.free_count = values
+            repaired += 1
+    db.session.commit()
+    return repaired